@@ -10,11 +10,21 @@
 # * * * * * * * * * * * * * * * * * * * * 
 
 import argparse
+import cProfile
+import glob
 import os
 import sys
 import img
+import instrument
+from patch import BestPatch
 from patch import ImgSet
-from scipy import misc
+from patch import PatchSampling
+from patch import SamplePatches
+from patch import SublistSamplePatches
+from patch import IndexedSamplePatches
+from patch import PCASamplePatches
+from patch import PrunedSamplePatches
+from cache import SampleCache
 
 
 
@@ -23,14 +33,55 @@ def validInput(args):
 
 	valid = True
 
-	# source.img
-	if not os.path.isfile(args.src):
-		print "Source image does not exist."
+	# source.img, or the sources of a batch or sequence
+	if args.batch and args.sequence:
+		print "Use one of batch and sequence mode."
 		valid = False
 
-	if not ImgSet.allowedFileType(args.src):
-		print "Source image is not an allowed file type:", valid_filetypes
-		valid = False
+	if args.batch or args.sequence:
+
+		if len(batchSources(args.src)) == 0:
+			print "No source images found for", args.src
+			valid = False
+
+		if not args.technique in ['linear', 'sublists', 'indexed', 'pca', 'pruned']:
+			print "Technique %s can't be used in batch or sequence mode." % (args.technique, )
+			valid = False
+
+		if args.patch_sizes is not None:
+			print "Batch and sequence mode re-draw with one patch size only."
+			valid = False
+
+		if args.batch and args.stream_rows > 0:
+			print "Batch mode re-draws whole sources, not streamed."
+			valid = False
+
+		if args.sequence and (args.workers > 1 or args.stream_rows > 0):
+			print "Sequence mode re-draws frame after frame in one process, not with workers or streamed."
+			valid = False
+
+	else:
+
+		if not os.path.isfile(args.src):
+			print "Source image does not exist."
+			valid = False
+
+		if not ImgSet.allowedFileType(args.src):
+			print "Source image is not an allowed file type:", valid_filetypes
+			valid = False
+
+		# patches are compared as integers
+		elif os.path.isfile(args.src):
+
+			try:
+				shape, dtype = ImgSet.readHeader(args.src)
+			except (IOError, ValueError):
+				print "Source image can't be read."
+				valid = False
+			else:
+				if dtype.kind not in "ui":
+					print "Source image pixels must be integers, not", dtype
+					valid = False
 
 	# sample/dir
 	if not os.path.isdir(args.sample_dir):
@@ -51,15 +102,61 @@ def validInput(args):
 			valid = False
 
 
-	# destination.img
-	if os.path.isfile(args.dest):
-		print "Destination image already exists."
+	# destination.img, or the destination directory of a batch or sequence
+	if args.batch or args.sequence:
+
+		if os.path.exists(args.dest) and not os.path.isdir(args.dest):
+			print "Destination of a batch or sequence must be a directory."
+			valid = False
+
+	else:
+
+		if os.path.isfile(args.dest):
+			print "Destination image already exists."
+			valid = False
+
+		if not ImgSet.allowedFileType(args.src):
+			print "Destination image is not an allowed file type:", valid_filetypes
+			valid = False
+
+	if args.overlap > 0 and (args.batch or args.sequence or args.stream_rows > 0):
+		print "Overlapping patches can't be used in batch or sequence mode or streamed."
 		valid = False
 
-	if not ImgSet.allowedFileType(args.src):
-		print "Destination image is not an allowed file type:", valid_filetypes
+	# options of the techniques searching a PatchStore, not used by pyramid and patchmatch
+	if args.technique in ['pyramid', 'patchmatch']:
+
+		unused = [option for option, given in [
+			('--workers', args.workers > 1),
+			('--stream-rows', args.stream_rows > 0),
+			('--overlap', args.overlap > 0),
+			('--dedup', args.dedup > 0),
+			('--sample-stride', args.sample_stride > 1),
+			('--sample-fraction', args.sample_fraction < 1.0),
+			('--sample-budget', args.sample_budget > 0),
+			('--augment', args.augment),
+			('--memo', args.memo > 0)] if given]
+
+		if len(unused) > 0:
+			print "Technique %s can't be used with %s." % (args.technique, ", ".join(unused))
+			valid = False
+
+	if args.overlap > min(min(size) for size in (args.patch_sizes if args.patch_sizes is not None else [args.patch_size])):
+		print "Overlap stride must be no larger than the patch size, or some pixels are never re-drawn."
 		valid = False
 
+	# one destination per patch size
+	if args.patch_sizes is not None:
+
+		if args.technique in ['pyramid', 'patchmatch']:
+			print "Technique %s re-draws with one patch size only." % (args.technique, )
+			valid = False
+
+		for size in args.patch_sizes:
+			if os.path.isfile(ImgSet.sizedName(args.dest, size)):
+				print "Destination image already exists:", ImgSet.sizedName(args.dest, size)
+				valid = False
+
 
 	return valid
 
@@ -68,6 +165,160 @@ def validInput(args):
 
 
 
+def patchSize(value):
+	""" Parse a patch size given as px_widthxpx_height (ex. 3x3) for argparse """
+
+	try:
+		width, height = [int(dim) for dim in value.lower().split("x")]
+	except ValueError:
+		raise argparse.ArgumentTypeError("patch size must be given as px_widthxpx_height, ex. 3x3")
+
+	if width <= 0 or height <= 0:
+		raise argparse.ArgumentTypeError("patch size must be positive")
+
+	return (width, height)
+
+
+def patchSizeList(value):
+	""" Parse comma separated patch sizes (ex. 3x3,5x5) for argparse """
+
+	return [patchSize(size) for size in value.split(",")]
+
+
+def positiveInt(value):
+	""" Parse an integer of at least 1 for argparse """
+
+	number = int(value)
+
+	if number < 1:
+		raise argparse.ArgumentTypeError("must be at least 1")
+
+	return number
+
+
+def fraction(value):
+	""" Parse a fraction in (0, 1] for argparse """
+
+	number = float(value)
+
+	if number <= 0.0 or number > 1.0:
+		raise argparse.ArgumentTypeError("must be greater than 0 and at most 1")
+
+	return number
+
+
+
+
+
+
+def batchSources(src):
+	""" Return sorted list of the source images of a batch, src being a directory of them,
+		a manifest (.txt, one file name per line) or a glob pattern
+	"""
+
+	if os.path.isdir(src):
+		return sorted(os.path.join(src, source_file) for source_file in os.listdir(src) if ImgSet.allowedFileType(source_file))
+
+	if src.endswith(".txt") and os.path.isfile(src):
+		with open(src) as manifest:
+			return sorted(line.strip() for line in manifest if ImgSet.allowedFileType(line.strip()))
+
+	return sorted(source_file for source_file in glob.glob(src) if ImgSet.allowedFileType(source_file))
+
+
+def sampleTechnique(args, cache):
+	""" Return (createSamplePatches(img_set, img_read), getBestPatch) of the technique and
+		options from the command line arguments, for batch mode and the server
+	"""
+
+	# every SamplePatches gets its own, as choosing patches at random keeps state
+	sampling = lambda: PatchSampling(args.sample_stride, args.sample_fraction, args.sample_budget, args.sample_seed)
+
+	if args.technique == 'linear':
+		return (lambda img_set, img_read: SamplePatches(img_set, img_read, cache=cache, dedup=args.dedup, sampling=sampling())), BestPatch.getBestPatch
+
+	elif args.technique == 'sublists':
+		return (lambda img_set, img_read: SublistSamplePatches(img_set, img_read, args.threshold, args.sublist_batch, cache=cache, dedup=args.dedup, sampling=sampling())), BestPatch.getBestPatchViaSublist
+
+	elif args.technique == 'indexed':
+		return (lambda img_set, img_read: IndexedSamplePatches(img_set, img_read, args.eps, cache=cache, dedup=args.dedup, sampling=sampling())), BestPatch.getBestPatch
+
+	elif args.technique == 'pca':
+		return (lambda img_set, img_read: PCASamplePatches(img_set, img_read, args.components, args.candidates, cache=cache, dedup=args.dedup, sampling=sampling())), BestPatch.getBestPatch
+
+	elif args.technique == 'pruned':
+		return (lambda img_set, img_read: PrunedSamplePatches(img_set, img_read, cache=cache, dedup=args.dedup, sampling=sampling())), BestPatch.getBestPatch
+
+
+def applyTechnique(args, img_set, cache):
+	""" Re-draw with the technique and options from the command line arguments """
+
+	if args.batch:
+		createSamplePatches, getBestPatch = sampleTechnique(args, cache)
+		img.batch(img_set, batchSources(args.src), args.dest, createSamplePatches, getBestPatch, args.patch_size, workers=args.workers, augment=args.augment, memo=args.memo, memo_quantize=args.memo_quantize)
+		return None
+
+	if args.sequence:
+		createSamplePatches, getBestPatch = sampleTechnique(args, cache)
+		img.sequence(img_set, batchSources(args.src), args.dest, createSamplePatches, getBestPatch, args.patch_size, tolerance=args.temporal_tolerance, augment=args.augment, memo=args.memo, memo_quantize=args.memo_quantize)
+		return None
+
+	sampling = PatchSampling(args.sample_stride, args.sample_fraction, args.sample_budget, args.sample_seed)
+
+	if args.technique == 'linear':
+		return img.linear(img_set, args.patch_size, cache=cache, workers=args.workers, strip_rows=args.stream_rows, dedup=args.dedup, sampling=sampling, augment=args.augment, overlap=args.overlap, feather=(args.blend == 'feather'), memo=args.memo, memo_quantize=args.memo_quantize)
+
+	elif args.technique == 'sublists':
+		return img.sublists(img_set, args.patch_size, args.threshold, args.sublist_batch, cache=cache, workers=args.workers, strip_rows=args.stream_rows, dedup=args.dedup, sampling=sampling, augment=args.augment, overlap=args.overlap, feather=(args.blend == 'feather'), memo=args.memo, memo_quantize=args.memo_quantize)
+
+	elif args.technique == 'indexed':
+		return img.indexed(img_set, args.patch_size, args.eps, cache=cache, workers=args.workers, strip_rows=args.stream_rows, dedup=args.dedup, sampling=sampling, augment=args.augment, overlap=args.overlap, feather=(args.blend == 'feather'), memo=args.memo, memo_quantize=args.memo_quantize)
+
+	elif args.technique == 'pca':
+		return img.pca(img_set, args.patch_size, args.components, args.candidates, cache=cache, workers=args.workers, strip_rows=args.stream_rows, dedup=args.dedup, sampling=sampling, augment=args.augment, overlap=args.overlap, feather=(args.blend == 'feather'), memo=args.memo, memo_quantize=args.memo_quantize)
+
+	elif args.technique == 'pruned':
+		return img.pruned(img_set, args.patch_size, cache=cache, workers=args.workers, strip_rows=args.stream_rows, dedup=args.dedup, sampling=sampling, augment=args.augment, overlap=args.overlap, feather=(args.blend == 'feather'), memo=args.memo, memo_quantize=args.memo_quantize)
+
+	elif args.technique == 'pyramid':
+		return img.pyramid(img_set, args.patch_size, args.levels, args.radius, cache=cache)
+
+	elif args.technique == 'patchmatch':
+		return img.patchmatch(img_set, args.patch_size, args.iterations, args.seed, cache=cache)
+
+
+
+
+
+
+def addTechniqueArguments(parser):
+	""" Add the options choosing the technique and how it finds the best sample patches to parser """
+
+	parser.add_argument('--dedup', metavar='Q', type=int, default=0, help='keep one sample patch per value after dividing pixels by Q, fewer patches to search, 1 drops exact duplicates only (default: 0, off; not used by pyramid or patchmatch)')
+	parser.add_argument('--sample-stride', metavar='N', type=positiveInt, default=1, help='take sample patches every N pixels across and down (default: 1, every pixel; not used by pyramid or patchmatch)')
+	parser.add_argument('--sample-fraction', metavar='F', type=fraction, default=1.0, help='take a random fraction F of the sample patches (default: 1, all; not used by pyramid or patchmatch)')
+	parser.add_argument('--sample-budget', metavar='N', type=int, default=0, help='take at most N sample patches at random, spread evenly over the samples (default: 0, no limit; not used by pyramid or patchmatch)')
+	parser.add_argument('--sample-seed', type=int, default=0, help='seed for choosing sample patches at random (default: 0)')
+	parser.add_argument('--augment', action='store_true', help='also match each source patch rotated and flipped, richer matches for up to 8 times the search (not used by pyramid or patchmatch)')
+	parser.add_argument('--memo', metavar='N', type=int, default=0, help='remember the best patches of the last N distinct source patches so repeated ones (flat or repeating regions) are searched once, hit rate is in --profile (default: 0, off; not used by pyramid or patchmatch)')
+	parser.add_argument('--memo-quantize', metavar='Q', type=int, default=0, help='with --memo, source patches equal after dividing pixels by Q share a match (default: 0, exact)')
+	parser.add_argument('--technique', choices=['linear', 'sublists', 'indexed', 'pca', 'pruned', 'pyramid', 'patchmatch'], default='sublists', help='technique used to find the best sample patches (default: sublists)')
+	parser.add_argument('--patch-size', metavar='WxH', type=patchSize, default=(3, 3), help='size of patches in pixels (default: 3x3)')
+	parser.add_argument('--threshold', type=float, default=0.85, help='sublists technique: comparison value required to join a sublist (default: 0.85)')
+	parser.add_argument('--sublist-batch', metavar='N', type=int, default=0, help='sublists technique: build sublists in mini-batches of N patches, faster but may group patches slightly differently, 0 adds one at a time (default: 0)')
+	parser.add_argument('--eps', type=float, default=0.0, help='indexed technique: accept matches within a factor of (1 + eps) of the best, 0 is exact (default: 0)')
+	parser.add_argument('--levels', type=int, default=3, help='pyramid technique: number of pyramid levels, each half the size of the one before (default: 3)')
+	parser.add_argument('--radius', type=int, default=2, help='pyramid technique: pixels around the match propagated from the coarser level searched (default: 2)')
+	parser.add_argument('--iterations', type=int, default=4, help='patchmatch technique: number of propagation and random search iterations (default: 4)')
+	parser.add_argument('--seed', type=int, default=0, help='patchmatch technique: seed for random search (default: 0)')
+	parser.add_argument('--components', metavar='K', type=int, default=8, help='pca technique: number of principal components patches are reduced to (default: 8)')
+	parser.add_argument('--candidates', metavar='M', type=int, default=16, help='pca technique: number of nearest candidates compared exactly (default: 16)')
+
+
+
+
+
+
 def main():
 	""" Main functionality for re-drawing images """
 
@@ -77,6 +328,18 @@ def main():
 	parser.add_argument('src', metavar='source.img', type=str, help='source image to be re-drawn')
 	parser.add_argument('sample_dir', metavar='sample/dir', type=str, help='directory of sample images to re-draw source with components from')
 	parser.add_argument('dest', metavar='destination.img', type=str, help='destination for re-drawn image')
+	parser.add_argument('--batch', action='store_true', help='re-draw many sources sharing the samples: source is a directory, manifest (.txt, one file per line) or quoted glob of source images and destination a directory, existing outputs are skipped, --workers re-draws that many sources at a time')
+	parser.add_argument('--sequence', action='store_true', help='re-draw the frames of a sequence in order, given like the sources of --batch (sorted by name), reusing the matches of patches unchanged from the frame before (not with --workers or --stream-rows)')
+	parser.add_argument('--temporal-tolerance', metavar='T', type=float, default=0.0, help='with --sequence, patches comparing to the frame before at 1 - T or more reuse its match (default: 0, unchanged patches only)')
+	parser.add_argument('--cache-dir', metavar='DIR', type=str, default=None, help='directory to cache decoded samples and sublists in, reused while the samples are unchanged')
+	parser.add_argument('--workers', metavar='N', type=int, default=1, help='number of processes re-drawing the source in parallel (default: 1; not used by pyramid or patchmatch)')
+	parser.add_argument('--stream-rows', metavar='N', type=int, default=0, help='re-draw the source in strips of N patch rows written out as they finish, with .npy source and destination neither is held in memory (default: 0, off; not used by pyramid or patchmatch)')
+	parser.add_argument('--profile', metavar='FILE', type=str, default=None, help='write JSON summary of time spent in each stage and counts of patches, candidates and comparisons')
+	parser.add_argument('--cprofile', metavar='FILE', type=str, default=None, help='write cProfile stats of the re-draw (main process only) for pstats')
+	parser.add_argument('--overlap', metavar='STRIDE', type=int, default=0, help='re-draw with overlapping patches STRIDE pixels apart, blended where they overlap to hide the seams between patches (default: 0, patches side by side; not used by pyramid or patchmatch)')
+	parser.add_argument('--blend', choices=['feather', 'uniform'], default='feather', help='with --overlap, weight patch pixels less towards patch edges (feather) or the same (uniform) (default: feather)')
+	parser.add_argument('--patch-sizes', metavar='WxH,...', type=patchSizeList, default=None, help='re-draw with each of these patch sizes instead, sharing the samples, saved with the size added to the destination name (ex. out_3x3.png)')
+	addTechniqueArguments(parser)
 
 	args = parser.parse_args()
 
@@ -87,6 +350,10 @@ def main():
 		sys.exit(1)
 
 
+	if args.patch_sizes is not None:
+		args.patch_size = args.patch_sizes
+
+
 	# Gather input into data structure
 
 	img_set = ImgSet(src=args.src, samples=[], dest=args.dest)
@@ -97,23 +364,48 @@ def main():
 					img_set.samples.append(args.sample_dir + "/" + sample_file)
 
 
+	cache = None
+
+	if args.cache_dir is not None:
+		cache = SampleCache(args.cache_dir)
+
+
 	# Apply technique
 
-	# Linear technique
-	# output_img = img.linear(img_set, (3, 3))
+	profiler = None
 
-	# Sublists technique
-	output_img = img.sublists(img_set, (3, 3), 0.85)
+	if args.cprofile is not None:
+		profiler = cProfile.Profile()
+		output_img = profiler.runcall(applyTechnique, args, img_set, cache)
+	else:
+		output_img = applyTechnique(args, img_set, cache)
 
 
 
 	# Save image
 
-	if output_img is not None:
-		misc.imsave(img_set.dest, output_img)
+	if isinstance(output_img, list):
+
+		for size, size_img in zip(args.patch_sizes, output_img):
+			ImgSet.writeImage(ImgSet.sizedName(img_set.dest, size), size_img)
+			print "Image saved as %s" % (ImgSet.sizedName(img_set.dest, size), )
+
+	elif output_img is not None:
+		ImgSet.writeImage(img_set.dest, output_img)
 		print "Image saved as %s" % (img_set.dest, )
 
 
+	# Profiling output
+
+	if profiler is not None:
+		profiler.dump_stats(args.cprofile)
+		print "cProfile stats saved as %s" % (args.cprofile, )
+
+	if args.profile is not None:
+		instrument.stats.dump(args.profile)
+		print "Profile saved as %s" % (args.profile, )
+
+
 
 
 if __name__ == "__main__":
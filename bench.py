@@ -0,0 +1,249 @@
+# * * * * * * * * * * * * * * * * * * * *
+# * bench.py
+# *
+# * Benchmark re-drawing techniques over
+# * patch sizes and thresholds using
+# * synthetic source and sample images
+# *
+# * * * * * * * * * * * * * * * * * * * *
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy
+from scipy import misc
+from scipy import ndimage
+import img
+from arachne import patchSize
+from patch import BestPatch
+from patch import ImgSet
+from patch import Patch
+from patch import SplitPatchInfo
+from patch import SamplePatches
+from patch import SublistSamplePatches
+from patch import IndexedSamplePatches
+from patch import PCASamplePatches
+from patch import PrunedSamplePatches
+
+
+
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
+# * Techniques
+
+def samplePatchesTechnique(createSamplePatches, getBestPatch):
+	""" Technique run through img.redraw, timing sample generation separately
+		createSamplePatches(img_set, img_read, threshold) returns the sample patches
+	"""
+
+	def run(img_set, img_read, patch_size, threshold):
+
+		samplePatches = createSamplePatches(img_set, img_read, threshold)
+
+		# generate samples of every patch size up front to time them separately
+		start = time.time()
+		for size in SplitPatchInfo(img_read, patch_size).patchSizes():
+			samplePatches.generate(Patch(pixels=img_read[:size[1], :size[0]]))
+		generateSeconds = time.time() - start
+
+		start = time.time()
+		img_write = img.redraw(img_read, patch_size, samplePatches, getBestPatch)
+		redrawSeconds = time.time() - start
+
+		return generateSeconds, redrawSeconds, img_write
+
+	return run
+
+
+def wholeTechnique(technique):
+	""" Technique run as a whole with technique(img_set, patch_size), sample generation
+		is part of its redraw time
+	"""
+
+	def run(img_set, img_read, patch_size, threshold):
+
+		start = time.time()
+		img_write = technique(img_set, patch_size)
+
+		return 0.0, time.time() - start, img_write
+
+	return run
+
+
+TECHNIQUES = {
+	'linear': samplePatchesTechnique(lambda img_set, img_read, threshold: SamplePatches(img_set, img_read), BestPatch.getBestPatch),
+	'sublists': samplePatchesTechnique(lambda img_set, img_read, threshold: SublistSamplePatches(img_set, img_read, threshold), BestPatch.getBestPatchViaSublist),
+	'indexed': samplePatchesTechnique(lambda img_set, img_read, threshold: IndexedSamplePatches(img_set, img_read), BestPatch.getBestPatch),
+	'pca': samplePatchesTechnique(lambda img_set, img_read, threshold: PCASamplePatches(img_set, img_read), BestPatch.getBestPatch),
+	'pruned': samplePatchesTechnique(lambda img_set, img_read, threshold: PrunedSamplePatches(img_set, img_read), BestPatch.getBestPatch),
+	'pyramid': wholeTechnique(img.pyramid),
+	'patchmatch': wholeTechnique(img.patchmatch)
+}
+
+# techniques whose results depend on the threshold
+THRESHOLD_TECHNIQUES = ['sublists']
+
+
+
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
+# * Benchmark
+
+def syntheticImage(size, random):
+	""" Generate a smooth random RGB image of size (px_width, px_height) with some noise """
+
+	coarse = random.rand(size[1] // 8 + 2, size[0] // 8 + 2, 3) * 255
+	smooth = ndimage.zoom(coarse, (8, 8, 1), order=1)[:size[1], :size[0]]
+	noise = random.normal(0, 8, smooth.shape)
+
+	return numpy.clip(smooth + noise, 0, 255).astype("uint8")
+
+
+def runCase(case):
+	""" Run one benchmark case in a worker process, returns result dictionary and output image """
+
+	technique, patch_size, threshold, src, samples = case
+
+	img_set = ImgSet(src=src, samples=samples, dest='')
+	img_read = ImgSet.readImage(src)
+
+	# keep per patch output out of the timings
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, "w")
+
+	try:
+		generateSeconds, redrawSeconds, img_write = TECHNIQUES[technique](img_set, img_read, patch_size, threshold)
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+	numPatches = SplitPatchInfo(img_read, patch_size).numPatches
+
+	result = {
+		"technique": technique,
+		"patch_size": list(patch_size),
+		"threshold": threshold,
+		"generate_seconds": generateSeconds,
+		"redraw_seconds": redrawSeconds,
+		"seconds_per_patch": redrawSeconds / numPatches,
+		"peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	}
+
+	return result, img_write
+
+
+def similarity(a, b):
+	""" Similarity of two images with the metric of Patch.comparePatches """
+
+	return float(Patch.comparePatchesBatch(Patch(pixels=a), b[numpy.newaxis])[0])
+
+
+def bench(techniques, patch_sizes, thresholds, source_size, sample_size, num_samples, seed):
+	""" Run every technique for every patch size (and threshold where it applies) against
+		synthetic images, each case in a fresh process so peak RSS is its own.
+		Returns list of result dictionaries.
+	"""
+
+	random = numpy.random.RandomState(seed)
+	imgDir = tempfile.mkdtemp(prefix="arachne-bench-")
+
+	try:
+		src = os.path.join(imgDir, "source.png")
+		misc.imsave(src, syntheticImage(source_size, random))
+
+		samples = []
+		for i in range(num_samples):
+			samples.append(os.path.join(imgDir, "sample%d.png" % (i, )))
+			misc.imsave(samples[-1], syntheticImage(sample_size, random))
+
+		results = []
+
+		for patch_size in patch_sizes:
+
+			# linear is the baseline for similarity
+			baseline = None
+
+			for technique in ['linear'] + [t for t in techniques if t != 'linear']:
+
+				for threshold in (thresholds if technique in THRESHOLD_TECHNIQUES else [None]):
+
+					pool = multiprocessing.Pool(1)
+					try:
+						result, img_write = pool.apply(runCase, ((technique, patch_size, threshold, src, samples), ))
+					finally:
+						pool.close()
+						pool.join()
+
+					if baseline is None:
+						baseline = img_write
+
+					result["similarity_to_linear"] = similarity(baseline, img_write)
+
+					print "%-10s %-8s %-6s generate %8.3fs  redraw %8.3fs  %.6fs/patch  %8d KB  similarity %.4f" % (
+						technique, "%dx%d" % patch_size, "-" if threshold is None else "%.2f" % (threshold, ),
+						result["generate_seconds"], result["redraw_seconds"], result["seconds_per_patch"],
+						result["peak_rss_kb"], result["similarity_to_linear"])
+
+					if technique in techniques:
+						results.append(result)
+
+		return results
+
+	finally:
+		shutil.rmtree(imgDir, ignore_errors=True)
+
+
+
+def main():
+	""" Run benchmarks and write results as JSON """
+
+	def sizeList(value):
+		return [patchSize(size) for size in value.split(",")]
+
+	def floatList(value):
+		return [float(number) for number in value.split(",")]
+
+	parser = argparse.ArgumentParser(description='Benchmark re-drawing techniques on synthetic images')
+	parser.add_argument('--techniques', type=lambda value: value.split(","), default=sorted(TECHNIQUES.keys()), help='comma separated techniques to run (default: all of %s)' % (",".join(sorted(TECHNIQUES.keys())), ))
+	parser.add_argument('--patch-sizes', metavar='WxH,...', type=sizeList, default=[(3, 3), (5, 5)], help='comma separated patch sizes (default: 3x3,5x5)')
+	parser.add_argument('--thresholds', type=floatList, default=[0.8, 0.9], help='comma separated sublist thresholds (default: 0.8,0.9)')
+	parser.add_argument('--source-size', metavar='WxH', type=patchSize, default=(48, 48), help='size of synthetic source image (default: 48x48)')
+	parser.add_argument('--sample-size', metavar='WxH', type=patchSize, default=(64, 64), help='size of each synthetic sample image (default: 64x64)')
+	parser.add_argument('--samples', type=int, default=2, help='number of synthetic sample images (default: 2)')
+	parser.add_argument('--seed', type=int, default=0, help='seed for synthetic images (default: 0)')
+	parser.add_argument('--out', type=str, default='bench.json', help='file to write JSON results to (default: bench.json)')
+
+	args = parser.parse_args()
+
+	for technique in args.techniques:
+		if not technique in TECHNIQUES:
+			print "Unknown technique:", technique
+			sys.exit(1)
+
+	results = bench(args.techniques, args.patch_sizes, args.thresholds, args.source_size, args.sample_size, args.samples, args.seed)
+
+	with open(args.out, "w") as out:
+		json.dump({
+			"config": {
+				"techniques": args.techniques,
+				"patch_sizes": [list(size) for size in args.patch_sizes],
+				"thresholds": args.thresholds,
+				"source_size": list(args.source_size),
+				"sample_size": list(args.sample_size),
+				"samples": args.samples,
+				"seed": args.seed
+			},
+			"results": results
+		}, out, indent=2)
+
+	print "Results written to %s" % (args.out, )
+
+
+
+
+if __name__ == "__main__":
+	main()
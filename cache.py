@@ -0,0 +1,88 @@
+# * * * * * * * * * * * * * * * * * * * *
+# * cache.py
+# *
+# * On-disk cache of decoded sample images
+# * and sublists so repeated runs against
+# * the same samples skip generation
+# *
+# * * * * * * * * * * * * * * * * * * * *
+import numpy
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+class SampleCache:
+	""" Directory of cache entries, each a directory of .npy arrays. Entries are keyed
+		by a hash of the sample files (path, mtime and size) and whatever else the
+		cached data depends on (patch size, threshold, ...), and are loaded memory
+		mapped so several processes can share one copy of the data.
+	"""
+
+	def __init__(self, cache_dir):
+		""" Constructor """
+
+		self.cacheDir = cache_dir
+
+		if not os.path.isdir(self.cacheDir):
+			os.makedirs(self.cacheDir)
+
+
+	@staticmethod
+	def fingerprint(paths):
+		""" Return a list of (absolute path, mtime, size) identifying the files at paths """
+
+		return [(os.path.abspath(path), os.path.getmtime(path), os.path.getsize(path)) for path in paths]
+
+
+	@staticmethod
+	def entryKey(*parts):
+		""" Return the name of the entry for the parts the cached data depends on """
+
+		return hashlib.sha1(repr(parts)).hexdigest()
+
+
+	def entryPath(self, key):
+		""" Return the directory of entry key """
+
+		return os.path.join(self.cacheDir, key)
+
+
+	def load(self, key):
+		""" Return a dictionary of name to memory mapped array for entry key,
+			None if there is no entry
+		"""
+
+		path = self.entryPath(key)
+
+		if not os.path.isdir(path):
+			return None
+
+		arrays = {}
+
+		for filename in os.listdir(path):
+			if filename.endswith(".npy"):
+				arrays[filename[:-len(".npy")]] = numpy.load(os.path.join(path, filename), mmap_mode="r")
+
+		return arrays
+
+
+	def save(self, key, arrays):
+		""" Save a dictionary of name to array as entry key and return it loaded back
+			memory mapped
+		"""
+
+		# write to a temporary directory first so a partial entry is never loaded
+		tmpPath = tempfile.mkdtemp(prefix=".tmp-", dir=self.cacheDir)
+
+		for name, arr in arrays.items():
+			numpy.save(os.path.join(tmpPath, name + ".npy"), numpy.ascontiguousarray(arr))
+
+		try:
+			os.rename(tmpPath, self.entryPath(key))
+		except OSError:
+			# another process saved the entry first
+			shutil.rmtree(tmpPath, ignore_errors=True)
+
+		return self.load(key)
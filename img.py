@@ -7,22 +7,627 @@
 # * 
 # * * * * * * * * * * * * * * * * * * * * 
 
-from scipy import misc
+from numpy.lib.stride_tricks import as_strided
 import numpy
 import math
-import copy
+import multiprocessing
+import os
+import tempfile
+import instrument
+from instrument import ProgressReporter
 from patch import BestPatch
+from patch import Patch
 from patch import ImgSet
 from patch import SplitPatchInfo
+from patch import OverlapPatchInfo
+from patch import PatchBlend
 from patch import SamplePatches
 from patch import SublistSamplePatches
+from patch import IndexedSamplePatches
+from patch import PCASamplePatches
+from patch import PrunedSamplePatches
+from patch import PyramidSamplePatches
+from patch import PatchPyramid
+from patch import PatchMatchField
+
+
+
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * 
+# * Re-drawing
+
+# state shared with worker processes (inherited when they are forked)
+_redrawState = None
+_batchState = None
+
+
+def readSource(img_set, strip_rows=0):
+	""" Read source image, memory mapped when streaming (strip_rows > 0) from a .npy source """
+
+	return ImgSet.readImage(img_set.src, mmap=(strip_rows > 0))
+
+
+def createCanvas(img_set, img_read, strip_rows=0):
+	""" Set up blank canvas for re-drawing img_read. When streaming (strip_rows > 0) the
+		canvas is memory mapped to the .npy destination, or to a temporary file next to
+		any other destination, so finished strips are written out instead of held in memory.
+	"""
+
+	if strip_rows <= 0:
+		return numpy.zeros(img_read.shape, dtype=img_read.dtype)
+
+	if img_set.dest.endswith(".npy"):
+		return numpy.lib.format.open_memmap(img_set.dest, mode="w+", dtype=img_read.dtype, shape=img_read.shape)
+
+	handle, filename = tempfile.mkstemp(suffix=".npy", dir=(os.path.dirname(os.path.abspath(img_set.dest))))
+	os.close(handle)
+
+	img_write = numpy.lib.format.open_memmap(filename, mode="w+", dtype=img_read.dtype, shape=img_read.shape)
+
+	# the mapping outlives the file name
+	os.remove(filename)
+
+	return img_write
+
+
+def patchSizeList(patch_size):
+	""" Return patch_size, a tuple of 2 ints (px_width, px_height) or a list of them,
+		as a list of patch sizes, None if it is neither
+	"""
+
+	patch_sizes = patch_size if isinstance(patch_size, list) else [patch_size]
+
+	if len(patch_sizes) == 0:
+		return None
+
+	for size in patch_sizes:
+		if not isinstance(size, tuple) or len(size) != 2 or not isinstance(size[0], int) or not isinstance(size[1], int):
+			return None
+
+	return patch_sizes
+
+
+def redrawSizes(img_set, img_read, patch_size, samplePatches, getBestPatch, workers=1, strip_rows=0, augment=False, overlap=0, feather=True, memo=0, memo_quantize=0):
+	""" Re-draw img_read with redraw on a canvas from createCanvas. With a list of patch
+		sizes, img_read is re-drawn once for each, all sharing samplePatches (so the samples
+		are decoded once), and the list of re-drawn images is returned. Streamed canvases
+		are then memory mapped to ImgSet.sizedName of the destination.
+	"""
+
+	if not isinstance(patch_size, list):
+		return redraw(img_read, patch_size, samplePatches, getBestPatch, img_write=createCanvas(img_set, img_read, strip_rows), workers=workers, strip_rows=strip_rows, augment=augment, overlap=overlap, feather=feather, memo=memo, memo_quantize=memo_quantize)
+
+	img_writes = []
+
+	for size in patch_size:
+		size_set = ImgSet(src=img_set.src, samples=img_set.samples, dest=ImgSet.sizedName(img_set.dest, size))
+		img_writes.append(redraw(img_read, size, samplePatches, getBestPatch, img_write=createCanvas(size_set, img_read, strip_rows), workers=workers, strip_rows=strip_rows, augment=augment, overlap=overlap, feather=feather, memo=memo, memo_quantize=memo_quantize))
+
+	return img_writes
+
+
+def redraw(img_read, patch_size, samplePatches, getBestPatch, workers=1, img_write=None, strip_rows=0, augment=False, overlap=0, feather=True, memo=0, memo_quantize=0):
+	""" Re-draw img_read patch by patch with the best patch found by getBestPatch(source_patch, samplePatches).
+		With workers > 1, bands of patch rows are re-drawn in that many processes, which share
+		samplePatches (generated up front) without copying it.
+		With strip_rows > 0, the source is re-drawn in strips of that many patch rows, each written
+		to img_write (flushed if memory mapped) once finished, so a memory mapped source and
+		canvas are never entirely in memory.
+		With augment, every source patch is also searched for rotated and flipped (see BestPatch.augment).
+		With overlap > 0, see redrawOverlap.
+		With memo > 0, the best patches of the last memo distinct source patches are remembered
+		(see BestPatch.memoize), so repeated source patches are only searched once.
+	"""
+
+	# Set up blank canvas
+	if img_write is None:
+		img_write = numpy.zeros(img_read.shape, dtype=img_read.dtype)
+
+	if overlap > 0:
+		return redrawOverlap(img_read, patch_size, overlap, samplePatches, getBestPatch, workers=workers, img_write=img_write, augment=augment, feather=feather, memo=memo, memo_quantize=memo_quantize)
+
+	# Get patch info
+	splitPatchInfo = SplitPatchInfo(img_read, patch_size)
+	print splitPatchInfo
+
+
+	getBestPatch = searchFunction(getBestPatch, augment=augment, memo=memo, memo_quantize=memo_quantize)
+
+	# Generate sample patches of every size now, so searches (and workers) don't generate them
+	for size in generatedSizes(img_read, patch_size, augment):
+		samplePatches.generateSize(size)
+
+	progress = ProgressReporter(splitPatchInfo.numPatches)
+
+
+	if workers <= 1 and strip_rows <= 0:
+
+		# Iterate over src patches
+		for source_patch, bounds in splitPatchInfo:
+
+			# use best patch to overwrite
+			bounds.boundWrite(img_write, searchPatch(source_patch, samplePatches, getBestPatch))
+			progress.update()
+
+		return img_write
+
+
+	# Bands of patch rows, strips when streaming, otherwise several per worker to balance the load
+	if strip_rows > 0:
+		rowsPerBand = strip_rows
+	else:
+		rowsPerBand = max(1, int(math.ceil(float(splitPatchInfo.patchRows) / (workers * 4))))
+
+	bands = [(row, min(row + rowsPerBand, splitPatchInfo.patchRows)) for row in range(0, splitPatchInfo.patchRows, rowsPerBand)]
+
+
+	if workers <= 1:
+
+		for band in bands:
+			writeBand(img_write, progress, patch_size, *redrawRows(img_read, patch_size, samplePatches, getBestPatch, band))
+
+		return img_write
+
+
+	global _redrawState
+	_redrawState = (img_read, patch_size, samplePatches, getBestPatch)
+
+	pool = multiprocessing.Pool(workers)
+
+	try:
+		for (startPxRow, endPxRow, band_write), band_stats in pool.imap_unordered(redrawBand, bands):
+			instrument.stats.merge(band_stats)
+			writeBand(img_write, progress, patch_size, startPxRow, endPxRow, band_write)
+
+	finally:
+		pool.close()
+		pool.join()
+		_redrawState = None
+
+
+	return img_write
+
+
+def generatedSizes(img_read, patch_size, augment=False):
+	""" Return the sizes of the sample patches re-drawing img_read needs, the sizes of its
+		split and with augment those sizes with width and height swapped (rotations)
+	"""
+
+	patchSizes = SplitPatchInfo(img_read, patch_size).patchSizes()
+
+	if augment:
+		patchSizes += [(size[1], size[0]) for size in patchSizes if not (size[1], size[0]) in patchSizes]
+
+	return patchSizes
+
+
+def redrawOverlap(img_read, patch_size, stride, samplePatches, getBestPatch, workers=1, img_write=None, augment=False, feather=True, memo=0, memo_quantize=0):
+	""" Re-draw img_read with overlapping patches, their upper left corners stride pixels
+		apart, blending the best patches where they overlap (see PatchBlend) instead of
+		overwriting. A stride under the patch size hides the seams between patches. With
+		workers > 1, bands of patch rows are searched in that many processes and blended
+		here as they finish. The whole canvas is blended at once, so it isn't streamed.
+	"""
+
+	if img_write is None:
+		img_write = numpy.zeros(img_read.shape, dtype=img_read.dtype)
+
+	overlapPatchInfo = OverlapPatchInfo(img_read, patch_size, stride)
+	print overlapPatchInfo
+
+	patchSizes = [patch_size]
+
+	getBestPatch = searchFunction(getBestPatch, augment=augment, memo=memo, memo_quantize=memo_quantize)
+
+	if augment:
+		patchSizes.append((patch_size[1], patch_size[0]))
+
+	# Generate sample patches now, so searches (and workers) don't generate them
+	for size in patchSizes:
+		samplePatches.generateSize(size)
+
+	progress = ProgressReporter(overlapPatchInfo.numPatches)
+	patchBlend = PatchBlend(img_read.shape, patch_size, feather)
+
+	# a band of patch rows at a time, several per worker to balance the load
+	rowsPerBand = max(1, int(math.ceil(float(overlapPatchInfo.patchRows) / (max(workers, 1) * 4))))
+	bands = [(row, min(row + rowsPerBand, overlapPatchInfo.patchRows)) for row in range(0, overlapPatchInfo.patchRows, rowsPerBand)]
+
+
+	if workers <= 1:
+
+		for band in bands:
+			positions, pixels = searchOverlapRows(overlapPatchInfo, samplePatches, getBestPatch, band)
+			blendBand(patchBlend, progress, positions, pixels)
+
+	else:
+
+		global _redrawState
+		_redrawState = (overlapPatchInfo, samplePatches, getBestPatch)
+
+		pool = multiprocessing.Pool(workers)
+
+		try:
+			for (positions, pixels), band_stats in pool.imap_unordered(searchOverlapBand, bands):
+				instrument.stats.merge(band_stats)
+				blendBand(patchBlend, progress, positions, pixels)
+
+		finally:
+			pool.close()
+			pool.join()
+			_redrawState = None
+
+
+	with instrument.stats.timer("write"):
+		img_write[...] = patchBlend.result(img_read.dtype)
+
+	return img_write
+
+
+def blendBand(patchBlend, progress, positions, pixels):
+	""" Blend the best patches of a band and report progress by their number """
+
+	with instrument.stats.timer("blend"):
+		patchBlend.add(positions, pixels)
+
+	progress.update(len(positions))
+
+
+def searchOverlapBand(band):
+	""" Search the band of overlapping patch rows (startPatchRow, endPatchRow) in a worker
+		process, returns the timers and counters of the worker along with the band
+	"""
+
+	return instrument.stats.isolated(searchOverlapRows, *(_redrawState + (band, )))
+
+
+def searchOverlapRows(overlapPatchInfo, samplePatches, getBestPatch, band):
+	""" Find the best patches for the band of overlapping patch rows (startPatchRow, endPatchRow),
+		returns (positions, pixels) of them, the pixels as one (N, px_height, px_width, channels) array
+	"""
+
+	positions = overlapPatchInfo.positions(band[0], band[1])
+	sourcePixels = overlapPatchInfo.patches(positions)
+	pixels = numpy.zeros(sourcePixels.shape, dtype=sourcePixels.dtype)
+
+	for i in range(len(positions)):
+
+		bestPatch = searchPatch(Patch(pixels=sourcePixels[i]), samplePatches, getBestPatch)
+
+		if bestPatch is not None:
+			pixels[i] = bestPatch.pixels
+
+	return positions, pixels
+
+
+def searchFunction(getBestPatch, augment=False, memo=0, memo_quantize=0):
+	""" Return getBestPatch searching rotated and flipped patches too with augment, and
+		remembering the best patches of the last memo distinct source patches with memo > 0
+		(see BestPatch.augment and BestPatch.memoize)
+	"""
+
+	if augment:
+		getBestPatch = BestPatch.augment(getBestPatch)
+
+	if memo > 0:
+		getBestPatch = BestPatch.memoize(getBestPatch, memo, memo_quantize)
+
+	return getBestPatch
+
+
+def searchPatch(source_patch, samplePatches, getBestPatch):
+	""" Find best patch for source_patch, timed and counted """
+
+	with instrument.stats.timer("search"):
+		bestPatch = getBestPatch(source_patch, samplePatches)
+
+	instrument.stats.count("patches")
+
+	return bestPatch
+
+
+def writeBand(img_write, progress, patch_size, startPxRow, endPxRow, band_write):
+	""" Write re-drawn band of rows to img_write and report progress by its number of patches """
+
+	with instrument.stats.timer("write"):
+
+		img_write[startPxRow:endPxRow] = band_write
+
+		if isinstance(img_write, numpy.memmap):
+			img_write.flush()
+
+	progress.update(Patch.numPatches(band_write, patch_size))
+
+
+def redrawBand(band):
+	""" Re-draw the band of patch rows (startPatchRow, endPatchRow) in a worker process,
+		returns the timers and counters of the worker along with the band
+	"""
+
+	return instrument.stats.isolated(redrawRows, *(_redrawState + (band, )))
+
+
+def redrawRows(img_read, patch_size, samplePatches, getBestPatch, band):
+	""" Re-draw the band of patch rows (startPatchRow, endPatchRow) of img_read,
+		returns (startPxRow, endPxRow, pixels)
+	"""
+
+	startPxRow = band[0] * patch_size[1]
+	endPxRow = min(band[1] * patch_size[1], img_read.shape[0])
+
+	band_read = numpy.asarray(img_read[startPxRow:endPxRow])
+	band_write = numpy.zeros(band_read.shape, dtype=band_read.dtype)
+
+	for source_patch, bounds in SplitPatchInfo(band_read, patch_size):
+		bounds.boundWrite(band_write, searchPatch(source_patch, samplePatches, getBestPatch))
+
+	return startPxRow, endPxRow, band_write
+
+
+
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * 
+# * Batch
+
+def batch(img_set, sources, dest_dir, createSamplePatches, getBestPatch, patch_size, workers=1, augment=False, memo=0, memo_quantize=0):
+	""" Re-draw each of the source images (file names) to a file of the same name in dest_dir,
+		all sharing the sample patches from createSamplePatches(img_set, img_read), which are
+		generated for every size up front. Sources whose output already exists, that aren't
+		encoded like the first source or are smaller than the patch size are skipped.
+		With workers > 1, that many sources are re-drawn at a time in processes sharing the
+		sample patches without copying them. Returns list of the outputs written.
+	"""
+
+	jobs, headers = sourceJobs(sources, dest_dir, patch_size)
+
+	if len(jobs) == 0:
+		return []
+
+
+	samplePatches = createSamplePatches(img_set, ImgSet.readImage(jobs[0][0]))
+
+	# Generate sample patches of every size any of the sources needs now, before workers start
+	sizes = []
+
+	for shape, dtype in headers:
+
+		# patch sizes only depend on the shape, no need to decode the source
+		img_shape = as_strided(numpy.zeros(1, dtype=dtype), shape=shape, strides=(0, ) * len(shape))
+		sizes += [size for size in generatedSizes(img_shape, patch_size, augment) if not size in sizes]
+
+	for size in sizes:
+		samplePatches.generateSize(size)
+
+	# one memo for every source (one per worker process), repeats across sources are common
+	getBestPatch = searchFunction(getBestPatch, augment=augment, memo=memo, memo_quantize=memo_quantize)
+
+
+	progress = ProgressReporter(len(jobs), label="Source")
+	written = []
+
+	if workers <= 1:
+
+		for src, dest in jobs:
+			written.append(redrawFile(src, dest, samplePatches, getBestPatch, patch_size))
+			progress.update()
+
+		return written
+
+
+	global _batchState
+	_batchState = (samplePatches, getBestPatch, patch_size)
+
+	pool = multiprocessing.Pool(workers)
+
+	try:
+		for dest, source_stats in pool.imap_unordered(redrawSource, jobs):
+			instrument.stats.merge(source_stats)
+			written.append(dest)
+			progress.update()
+
+	finally:
+		pool.close()
+		pool.join()
+		_batchState = None
+
+
+	return written
+
+
+def sourceJobs(sources, dest_dir, patch_size, skip_existing=True):
+	""" Return list of (src, dest) of the sources to re-draw to a file of the same name in
+		dest_dir, and list of their (shape, dtype). Sources that aren't encoded like the first
+		source or are smaller than the patch size are skipped, as are those whose output
+		already exists with skip_existing, or is the output of an earlier source of the same
+		name (from another directory). Creates dest_dir if needed.
+	"""
+
+	jobs = []
+	headers = []
+	dests = set()
+
+	for src in sources:
+
+		dest = os.path.join(dest_dir, os.path.basename(src))
+
+		if dest in dests:
+			print "Skipping %s, an earlier source is also re-drawn to %s" % (src, dest)
+			continue
+
+		if skip_existing and os.path.isfile(dest):
+			print "Skipping %s, %s already exists" % (src, dest)
+			continue
+
+		try:
+			shape, dtype = ImgSet.readHeader(src)
+		except (IOError, ValueError):
+			print "Skipping unreadable source", src
+			continue
+
+		if dtype.kind not in "ui":
+			print "Skipping %s, pixels aren't integers" % (src, )
+			continue
+
+		if len(shape) != 3 or (len(headers) > 0 and (shape[2] != headers[0][0][2] or dtype != headers[0][1])):
+			print "Skipping %s, not encoded like the first source" % (src, )
+			continue
+
+		if patch_size[0] > shape[1] or patch_size[1] > shape[0]:
+			print "Skipping %s, patch size larger than image" % (src, )
+			continue
+
+		jobs.append((src, dest))
+		headers.append((shape, dtype))
+		dests.add(dest)
+
+	if len(jobs) > 0 and not os.path.isdir(dest_dir):
+		os.makedirs(dest_dir)
+
+	return jobs, headers
+
+
+def redrawSource(job):
+	""" Re-draw the source of job (src, dest) in a worker process, returns the output written
+		and the timers and counters of the worker
+	"""
+
+	return instrument.stats.isolated(redrawFile, *(job + _batchState))
+
+
+def redrawFile(src, dest, samplePatches, getBestPatch, patch_size):
+	""" Re-draw image file src to dest, returns dest """
+
+	ImgSet.writeImage(dest, redraw(ImgSet.readImage(src), patch_size, samplePatches, getBestPatch))
+	print "Image saved as %s" % (dest, )
+
+	return dest
+
+
+
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * 
+# * Sequences
+
+def sequence(img_set, sources, dest_dir, createSamplePatches, getBestPatch, patch_size, tolerance=0.0, augment=False, memo=0, memo_quantize=0):
+	""" Re-draw the frames of a sequence (file names, in order) to files of the same name in
+		dest_dir, sharing the sample patches from createSamplePatches(img_set, img_read).
+		Each frame is re-drawn with redrawFrame from the frame before it. A frame whose
+		output already exists isn't re-drawn, its output is read to continue from instead.
+		With augment and memo, see redraw, the memo being kept across frames.
+		Returns list of the outputs written.
+	"""
+
+	jobs, headers = sourceJobs(sources, dest_dir, patch_size, skip_existing=False)
+
+	if len(jobs) == 0:
+		return []
+
+	samplePatches = createSamplePatches(img_set, ImgSet.readImage(jobs[0][0]))
+	searchBestPatch = searchFunction(getBestPatch, augment=augment, memo=memo, memo_quantize=memo_quantize)
+
+	# a plain search can be bounded by the previous match, not one rotating or remembering
+	seeded = (searchBestPatch is BestPatch.getBestPatch)
+
+	progress = ProgressReporter(len(jobs), label="Frame")
+	written = []
+
+	prev_read = None
+	prev_write = None
+
+	for src, dest in jobs:
+
+		img_read = ImgSet.readImage(src)
+
+		if os.path.isfile(dest):
+			print "Continuing from %s, already exists" % (dest, )
+			img_write = ImgSet.readImage(dest)
+
+		else:
+			img_write = redrawFrame(img_read, patch_size, samplePatches, searchBestPatch, prev_read=prev_read, prev_write=prev_write, tolerance=tolerance, augment=augment, seeded=seeded)
+			ImgSet.writeImage(dest, img_write)
+			print "Image saved as %s" % (dest, )
+			written.append(dest)
+
+		prev_read = img_read
+		prev_write = img_write
+		progress.update()
+
+	return written
+
+
+def redrawFrame(img_read, patch_size, samplePatches, getBestPatch, prev_read=None, prev_write=None, tolerance=0.0, augment=False, seeded=False):
+	""" Re-draw a frame img_read of a sequence from the frame before it, prev_read re-drawn as
+		prev_write. Patches of the SplitPatchInfo grid that compare to the same patch of
+		prev_read at 1 - tolerance or more keep its match from prev_write without a search.
+		Others are searched for, and the match from prev_write is kept when nothing compares
+		better (ties included), which reduces flicker between frames.
+		With seeded, getBestPatch is BestPatch.getBestPatch and changed patches are seeded
+		with the match from prev_write instead: only patches closer than it are searched for
+		(see BestPatch.getBestPatchWithin), which prunes the search of PrunedSamplePatches.
+		getBestPatch is used as given (see searchFunction), augment only tells which sizes
+		of sample patches it needs. Counts temporal_reused, temporal_searched and
+		temporal_kept patches.
+	"""
+
+	# Generate sample patches of every size now
+	for size in generatedSizes(img_read, patch_size, augment):
+		samplePatches.generateSize(size)
+
+	if prev_read is None or prev_read.shape != img_read.shape:
+		return redraw(img_read, patch_size, samplePatches, getBestPatch)
+
+	img_write = numpy.zeros(img_read.shape, dtype=img_read.dtype)
+	splitPatchInfo = SplitPatchInfo(img_read, patch_size)
+
+	# compare every patch to the frame before at once, summing differences over the grid
+	with instrument.stats.timer("temporal"):
+		diff = numpy.abs(numpy.asarray(img_read, dtype="int32") - numpy.asarray(prev_read, dtype="int32")).sum(axis=2)
+		rowStarts = numpy.arange(0, img_read.shape[0], patch_size[1])
+		colStarts = numpy.arange(0, img_read.shape[1], patch_size[0])
+		distances = numpy.add.reduceat(numpy.add.reduceat(diff, rowStarts, axis=0), colStarts, axis=1)
+
+	progress = ProgressReporter(splitPatchInfo.numPatches)
+
+	for source_patch, bounds in splitPatchInfo:
+
+		prev_patch = Patch(pixels=bounds.boundView(prev_write))
+		distance = distances[bounds.startPxRow // patch_size[1], bounds.startPxCol // patch_size[0]]
+
+		if 1.0 - (distance / float(source_patch.pixels.size * 255)) >= 1.0 - tolerance:
+			instrument.stats.count("temporal_reused")
+			bounds.boundWrite(img_write, prev_patch)
+
+		else:
+			instrument.stats.count("temporal_searched")
+
+			if seeded:
+				prevDistance = int(Patch.distanceBatch(source_patch, prev_patch.pixels[numpy.newaxis])[0])
+				bestPatch = searchPatch(source_patch, samplePatches, lambda patch, samplePatches: BestPatch.getBestPatchWithin(patch, samplePatches, prevDistance))
+				keep = (bestPatch is None)
+
+			else:
+				bestPatch = searchPatch(source_patch, samplePatches, getBestPatch)
+
+				# break ties in favour of the match of the frame before
+				keep = (bestPatch is None or bestPatch.pixels.shape != prev_patch.pixels.shape)
+
+				if not keep:
+					values = Patch.comparePatchesBatch(source_patch, numpy.array([prev_patch.pixels, bestPatch.pixels]))
+					keep = (values[0] >= values[1])
+
+			if keep:
+				instrument.stats.count("temporal_kept")
+				bestPatch = prev_patch
+
+			bounds.boundWrite(img_write, bestPatch)
+
+		progress.update()
+
+	return img_write
 
 
 
 # * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * 
 # * Techniques/Operations
 
-def linear(img_set, patch_size):
+def linear(img_set, patch_size, cache=None, workers=1, strip_rows=0, dedup=0, sampling=None, augment=False, overlap=0, feather=True, memo=0, memo_quantize=0):
 	""" Linear comparison of samples to source with specified patch size (px_width, px_height)
 		This is a VERY slow operation.
 	"""
@@ -32,60 +637,269 @@ def linear(img_set, patch_size):
 		print "img_set in img.linear() must be of type img.ImgSet"
 		return None
 
+	patch_sizes = patchSizeList(patch_size)
+
+	if patch_sizes is None:
+		print "patch_size in img.linear() must be a tuple of 2 ints or a list of them"
+		return None
+
+
+	# Get ndarray for image
+	img_read = readSource(img_set, strip_rows)
+
+	if max(size[0] for size in patch_sizes) > img_read.shape[1] or max(size[1] for size in patch_sizes) > img_read.shape[0]:
+		print "Patch size larger than image"
+		return None
+
+	# Set up sample patches
+	samplePatches = SamplePatches(img_set, img_read, cache=cache, dedup=dedup, sampling=sampling)
+
+
+
+	# Re-draw src patches with best patches (for each patch size)
+	return redrawSizes(img_set, img_read, patch_size, samplePatches, BestPatch.getBestPatch, workers=workers, strip_rows=strip_rows, augment=augment, overlap=overlap, feather=feather, memo=memo, memo_quantize=memo_quantize)
+
+
+def sublists(img_set, patch_size, threshold, batch_size=0, cache=None, workers=1, strip_rows=0, dedup=0, sampling=None, augment=False, overlap=0, feather=True, memo=0, memo_quantize=0):
+	""" Using sublists that are generated from the samples to reduce the number of patches searched through
+		(batch_size > 0 builds the sublists in mini-batches, see PatchSublistManager)
+	"""
+
+	# Valid input
+	if not isinstance(img_set, ImgSet):
+		print "img_set in img.sublists() must be of type img.ImgSet"
+		return None
+
+	patch_sizes = patchSizeList(patch_size)
+
+	if patch_sizes is None:
+		print "patch_size in img.sublists() must be a tuple of 2 ints or a list of them"
+		return None
+
+
+	# Get ndarray for image
+	img_read = readSource(img_set, strip_rows)
+
+	if max(size[0] for size in patch_sizes) > img_read.shape[1] or max(size[1] for size in patch_sizes) > img_read.shape[0]:
+		print "Patch size larger than image"
+		return None
+
+	# Set up sample patches
+	sublistSamplePatches = SublistSamplePatches(img_set, img_read, threshold, batch_size, cache=cache, dedup=dedup, sampling=sampling)
+
+
+
+	# Re-draw src patches with best patches (for each patch size)
+	return redrawSizes(img_set, img_read, patch_size, sublistSamplePatches, BestPatch.getBestPatchViaSublist, workers=workers, strip_rows=strip_rows, augment=augment, overlap=overlap, feather=feather, memo=memo, memo_quantize=memo_quantize)
+
+
+def indexed(img_set, patch_size, eps=0.0, cache=None, workers=1, strip_rows=0, dedup=0, sampling=None, augment=False, overlap=0, feather=True, memo=0, memo_quantize=0):
+	""" Using a KD-tree index over the samples to find the best patch without comparing to
+		every sample patch. eps of 0 gives the same result as linear, eps > 0 trades
+		accuracy for speed (distance within a factor of (1 + eps) of the best).
+	"""
+
+	# Valid input
+	if not isinstance(img_set, ImgSet):
+		print "img_set in img.indexed() must be of type img.ImgSet"
+		return None
+
+	patch_sizes = patchSizeList(patch_size)
+
+	if patch_sizes is None:
+		print "patch_size in img.indexed() must be a tuple of 2 ints or a list of them"
+		return None
+
+
+	# Get ndarray for image
+	img_read = readSource(img_set, strip_rows)
+
+	if max(size[0] for size in patch_sizes) > img_read.shape[1] or max(size[1] for size in patch_sizes) > img_read.shape[0]:
+		print "Patch size larger than image"
+		return None
+
+	# Set up sample patches
+	indexedSamplePatches = IndexedSamplePatches(img_set, img_read, eps, cache=cache, dedup=dedup, sampling=sampling)
+
+
+
+	# Re-draw src patches with best patches (for each patch size)
+	return redrawSizes(img_set, img_read, patch_size, indexedSamplePatches, BestPatch.getBestPatch, workers=workers, strip_rows=strip_rows, augment=augment, overlap=overlap, feather=feather, memo=memo, memo_quantize=memo_quantize)
+
+
+def pca(img_set, patch_size, components, candidates, cache=None, workers=1, strip_rows=0, dedup=0, sampling=None, augment=False, overlap=0, feather=True, memo=0, memo_quantize=0):
+	""" Using sample patches reduced to their first components (k) to find a number of
+		candidates (m) that are compared exactly, approximating linear at a fraction
+		of the cost for large patch sizes
+	"""
+
+	# Valid input
+	if not isinstance(img_set, ImgSet):
+		print "img_set in img.pca() must be of type img.ImgSet"
+		return None
+
+	patch_sizes = patchSizeList(patch_size)
+
+	if patch_sizes is None:
+		print "patch_size in img.pca() must be a tuple of 2 ints or a list of them"
+		return None
+
+
+	# Get ndarray for image
+	img_read = readSource(img_set, strip_rows)
+
+	if max(size[0] for size in patch_sizes) > img_read.shape[1] or max(size[1] for size in patch_sizes) > img_read.shape[0]:
+		print "Patch size larger than image"
+		return None
+
+	# Set up sample patches
+	pcaSamplePatches = PCASamplePatches(img_set, img_read, components, candidates, cache=cache, dedup=dedup, sampling=sampling)
+
+
+
+	# Re-draw src patches with best patches (for each patch size)
+	return redrawSizes(img_set, img_read, patch_size, pcaSamplePatches, BestPatch.getBestPatch, workers=workers, strip_rows=strip_rows, augment=augment, overlap=overlap, feather=feather, memo=memo, memo_quantize=memo_quantize)
+
+
+def pruned(img_set, patch_size, cache=None, workers=1, strip_rows=0, dedup=0, sampling=None, augment=False, overlap=0, feather=True, memo=0, memo_quantize=0):
+	""" Linear comparison of samples to source where most sample patches are ruled out by
+		cheap bounds on how different they can be, the same result as linear for a
+		fraction of the comparisons
+	"""
+
+	# Valid input
+	if not isinstance(img_set, ImgSet):
+		print "img_set in img.pruned() must be of type img.ImgSet"
+		return None
+
+	patch_sizes = patchSizeList(patch_size)
+
+	if patch_sizes is None:
+		print "patch_size in img.pruned() must be a tuple of 2 ints or a list of them"
+		return None
+
+
+	# Get ndarray for image
+	img_read = readSource(img_set, strip_rows)
+
+	if max(size[0] for size in patch_sizes) > img_read.shape[1] or max(size[1] for size in patch_sizes) > img_read.shape[0]:
+		print "Patch size larger than image"
+		return None
+
+	# Set up sample patches
+	prunedSamplePatches = PrunedSamplePatches(img_set, img_read, cache=cache, dedup=dedup, sampling=sampling)
+
+
+
+	# Re-draw src patches with best patches (for each patch size)
+	return redrawSizes(img_set, img_read, patch_size, prunedSamplePatches, BestPatch.getBestPatch, workers=workers, strip_rows=strip_rows, augment=augment, overlap=overlap, feather=feather, memo=memo, memo_quantize=memo_quantize)
+
+
+def pyramid(img_set, patch_size, levels=3, radius=2, cache=None):
+	""" Coarse to fine matching over mean pyramids of the source and samples (each level half
+		the size of the one before). Patches are searched for linearly at the coarsest level,
+		then at each finer level only within radius pixels of where the match of the patch
+		above it leads. Samples too small for the coarsest level are left out.
+	"""
+
+	# Valid input
+	if not isinstance(img_set, ImgSet):
+		print "img_set in img.pyramid() must be of type img.ImgSet"
+		return None
+
 	if not isinstance(patch_size, tuple) or len(patch_size) != 2 or not isinstance(patch_size[0], int) or not isinstance(patch_size[1], int):
-		print "patch_size in img.linear() must be a tuple of 2 ints"
+		print "patch_size in img.pyramid() must be a tuple of 2 ints"
 		return None
 
 
 	# Get ndarray for image
-	img_read = misc.imread(img_set.src)
+	img_read = readSource(img_set)
 
 	if patch_size[0] > img_read.shape[1] or patch_size[1] > img_read.shape[0]:
 		print "Patch size larger than image"
 		return None
 
+	# No more levels than the source can fit a patch in
+	levels = max(1, levels)
+	while levels > 1:
+		coarsest = PatchPyramid.levelSize((img_read.shape[1], img_read.shape[0]), levels - 1)
+		if coarsest[0] >= patch_size[0] and coarsest[1] >= patch_size[1]:
+			break
+		levels -= 1
+
+	print "%d pyramid levels" % (levels, )
+
 	# Set up blank canvas
 	img_write = numpy.zeros(img_read.shape, dtype=img_read.dtype)
 
+	# Set up sample patches
+	pyramidSamplePatches = PyramidSamplePatches(img_set, img_read, levels, patch_size, cache)
 
+	if len(pyramidSamplePatches.samplePyramids()[0]) == 0:
+		print "No samples large enough for %d pyramid levels" % (levels, )
+		return img_write
 
-	# Get patch info
-	splitPatchInfo = SplitPatchInfo(img_read, patch_size)
-	print splitPatchInfo
 
-	# Set up sample patches
-	samplePatches = SamplePatches(img_set, img_read)
 
+	# Match from coarsest to finest level, (image index, y, x) of the match of each patch
+	matches = None
 
+	for level, source_level in reversed(list(enumerate(PatchPyramid.build(img_read, levels)))):
 
-	# Iterate over src patches
-	for source_patch, bounds in splitPatchInfo:
+		splitPatchInfo = SplitPatchInfo(source_level, patch_size)
+		progress = ProgressReporter(splitPatchInfo.numPatches, label="Level %d patch" % (level, ))
+		levelMatches = {}
+
+		for source_patch, bounds in splitPatchInfo:
+
+			patchRow, patchCol = divmod(splitPatchInfo.currentPatchNum, splitPatchInfo.patchCols)
+
+			with instrument.stats.timer("search"):
+
+				if matches is None:
+					bestIndex, bestValue = pyramidSamplePatches.getBestIndexAt(source_patch, level)
+
+				else:
+					# where the match of the patch above leads, offset by where this patch is within it
+					imageIndex, y, x = matches[(patchRow // 2, patchCol // 2)]
+					bestIndex, bestValue = pyramidSamplePatches.getBestIndexNear(source_patch, level, imageIndex,
+						2 * y + (patchRow % 2) * patch_size[1], 2 * x + (patchCol % 2) * patch_size[0], radius)
 
-		print "Patch %d" % (splitPatchInfo.currentPatchNum, )
+			instrument.stats.count("patches")
 
-		# use best patch to overwrite
-		bounds.boundWrite(img_write, BestPatch.getBestPatch(source_patch, samplePatches))
+			key = source_patch.getPatchSize()
+			levelMatches[(patchRow, patchCol)] = pyramidSamplePatches.getLevelStore(level, key).locate(bestIndex)
 
+			if level == 0:
+				bounds.boundWrite(img_write, pyramidSamplePatches.getLevelPatch(level, key, bestIndex))
+
+			progress.update()
+
+		matches = levelMatches
 
 
 	return img_write
 
 
-def sublists(img_set, patch_size, threshold):
-	""" Using sublists that are generated from the samples to reduce the number of patches searched through """
+def patchmatch(img_set, patch_size, iterations=4, seed=0, cache=None):
+	""" PatchMatch style search: a nearest neighbour field over the source patches improved by
+		propagating matches between neighbouring patches and random search, so each patch
+		costs about the same no matter the number of sample patches. Samples smaller than
+		the patch size are left out.
+	"""
 
 	# Valid input
 	if not isinstance(img_set, ImgSet):
-		print "img_set in img.sublists() must be of type img.ImgSet"
+		print "img_set in img.patchmatch() must be of type img.ImgSet"
 		return None
 
 	if not isinstance(patch_size, tuple) or len(patch_size) != 2 or not isinstance(patch_size[0], int) or not isinstance(patch_size[1], int):
-		print "patch_size in img.sublists() must be a tuple of 2 ints"
+		print "patch_size in img.patchmatch() must be a tuple of 2 ints"
 		return None
 
 
 	# Get ndarray for image
-	img_read = misc.imread(img_set.src)
+	img_read = readSource(img_set)
 
 	if patch_size[0] > img_read.shape[1] or patch_size[1] > img_read.shape[0]:
 		print "Patch size larger than image"
@@ -94,26 +908,24 @@ def sublists(img_set, patch_size, threshold):
 	# Set up blank canvas
 	img_write = numpy.zeros(img_read.shape, dtype=img_read.dtype)
 
+	# Set up sample patches, a single level pyramid is just the samples
+	samplePatches = PyramidSamplePatches(img_set, img_read, 1, patch_size, cache)
 
+	if len(samplePatches.samplePyramids()[0]) == 0:
+		print "No samples large enough for patch size"
+		return img_write
 
 
-	# Get patch info
-	splitPatchInfo = SplitPatchInfo(img_read, patch_size)
-	print splitPatchInfo
-
-	# Set up sample patches
-	sublistSamplePatches = SublistSamplePatches(img_set, img_read, threshold)
 
+	# Search
+	field = PatchMatchField(img_read, patch_size, samplePatches, seed=seed)
 
+	with instrument.stats.timer("search"):
+		field.run(iterations)
 
-	# Iterate over src patches
-	for source_patch, bounds in splitPatchInfo:
-
-		print "Patch %d" % (splitPatchInfo.currentPatchNum, )
+	instrument.stats.count("patches", field.patchRows * field.patchCols)
 
-		# use best patch to overwrite
-		bounds.boundWrite(img_write, BestPatch.getBestPatchViaSublist(source_patch, sublistSamplePatches))
+	field.write(img_write)
 
 
-	
 	return img_write
\ No newline at end of file
@@ -0,0 +1,160 @@
+# * * * * * * * * * * * * * * * * * * * *
+# * instrument.py
+# *
+# * Timers, counters and progress
+# * reporting for the stages of
+# * re-drawing an image
+# *
+# * * * * * * * * * * * * * * * * * * * *
+import contextlib
+import json
+import threading
+import time
+
+
+class Instrumentation:
+	""" Named timers (total seconds and calls) and counters. Timers may nest, for
+		example generate includes the decode of sample images. Safe to update from
+		several threads.
+	"""
+
+	def __init__(self):
+		""" Constructor """
+
+		self.lock = threading.Lock()
+		self.reset()
+
+
+	def reset(self):
+		""" Clear all timers and counters """
+
+		self.timers = {}
+		self.counters = {}
+		self.started = time.time()
+
+
+	def add(self, name, seconds, calls=1):
+		""" Add seconds over a number of calls to timer name """
+
+		with self.lock:
+			timer = self.timers.setdefault(name, [0.0, 0])
+			timer[0] += seconds
+			timer[1] += calls
+
+
+	def count(self, name, value=1):
+		""" Add value to counter name """
+
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+
+	@contextlib.contextmanager
+	def timer(self, name):
+		""" Context manager timing its block under timer name """
+
+		start = time.time()
+
+		try:
+			yield
+		finally:
+			self.add(name, time.time() - start)
+
+
+	def isolated(self, function, *args):
+		""" Call function(*args) in a worker process, returns its result and a snapshot of
+			only the timers and counters it added, not those inherited from the parent
+		"""
+
+		self.reset()
+		result = function(*args)
+
+		return result, self.snapshot()
+
+
+	def snapshot(self):
+		""" Return copy of timers and counters, can be merged into another Instrumentation """
+
+		return {"timers": dict((name, list(timer)) for name, timer in self.timers.items()), "counters": dict(self.counters)}
+
+
+	def merge(self, snapshot):
+		""" Add the timers and counters of a snapshot (ex. from a worker process) """
+
+		for name, timer in snapshot["timers"].items():
+			self.add(name, timer[0], timer[1])
+
+		for name, value in snapshot["counters"].items():
+			self.count(name, value)
+
+
+	def summary(self):
+		""" Return dictionary summarizing wall time, timers and counters, with the hit rate
+			of each pair of counters name_hits and name_misses
+		"""
+
+		rates = {}
+
+		for name, hits in self.counters.items():
+
+			if name.endswith("_hits") and name[:-len("_hits")] + "_misses" in self.counters:
+				lookups = hits + self.counters[name[:-len("_hits")] + "_misses"]
+				rates[name[:-len("_hits")] + "_hit_rate"] = float(hits) / lookups if lookups > 0 else 0.0
+
+		return {
+			"wall_seconds": time.time() - self.started,
+			"timers": dict((name, {"seconds": timer[0], "calls": timer[1]}) for name, timer in self.timers.items()),
+			"counters": dict(self.counters),
+			"rates": rates
+		}
+
+
+	def dump(self, filename):
+		""" Write summary to filename as JSON """
+
+		with open(filename, "w") as out:
+			json.dump(self.summary(), out, indent=2, sort_keys=True)
+
+
+
+class ProgressReporter:
+	""" Print progress towards a total with rate and estimated time remaining,
+		at most once per interval seconds (and once when done)
+	"""
+
+	def __init__(self, total, label="Patch", interval=1.0):
+		""" Constructor """
+
+		self.total = total
+		self.label = label
+		self.interval = interval
+
+		self.done = 0
+		self.started = time.time()
+		self.lastReport = self.started
+
+
+	def update(self, done=1):
+		""" Record done more units of progress """
+
+		self.done += done
+		now = time.time()
+
+		if self.done >= self.total or now - self.lastReport >= self.interval:
+			self.lastReport = now
+			self.report(now)
+
+
+	def report(self, now):
+		""" Print progress """
+
+		elapsed = max(now - self.started, 1e-9)
+		rate = self.done / elapsed
+		remaining = (self.total - self.done) / rate if rate > 0 else 0.0
+
+		print "%s %d/%d (%.1f%%) %.1f/s ETA %ds" % (self.label, self.done, self.total, 100.0 * self.done / max(self.total, 1), rate, remaining)
+
+
+
+# instrumentation shared by the modules of a run
+stats = Instrumentation()
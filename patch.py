@@ -6,9 +6,18 @@
 # * 
 # * * * * * * * * * * * * * * * * * * * *
 from scipy import misc
+from PIL import Image
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+from numpy.lib.stride_tricks import as_strided
+from multiprocessing.pool import ThreadPool
 import numpy
 import math
 import copy
+import bisect
+import collections
+import os
+import instrument
 
 
 class ImgSet:
@@ -17,7 +26,7 @@ class ImgSet:
 		for re-drawn image.
 	"""
 
-	valid_filetypes = ['jpg', 'png']
+	valid_filetypes = ['jpg', 'png', 'npy']
 
 
 	def __init__(self, src='', samples=[], dest=''):
@@ -41,6 +50,77 @@ class ImgSet:
 		return False
 
 
+	@staticmethod
+	def readImage(filename, mmap=False):
+		""" Read image as an ndarray, .npy arrays can be memory mapped
+			(read as needed instead of all at once)
+		"""
+
+		with instrument.stats.timer("decode"):
+
+			if filename.endswith(".npy"):
+				return numpy.load(filename, mmap_mode=("r" if mmap else None))
+
+			return misc.imread(filename)
+
+
+	@staticmethod
+	def readHeader(filename):
+		""" Return (shape, dtype) the ndarray from readImage would have, from the header of
+			the image without decoding its pixels
+		"""
+
+		if filename.endswith(".npy"):
+			header = numpy.load(filename, mmap_mode="r")
+			return header.shape, header.dtype
+
+		header = Image.open(filename)
+		mode = header.mode
+
+		# as misc.imread converts them
+		if mode == 'P':
+			mode = 'RGBA' if 'transparency' in header.info else 'RGB'
+		elif mode == '1':
+			mode = 'L'
+
+		dtype = {'I': numpy.dtype('int32'), 'F': numpy.dtype('float32'), 'I;16': numpy.dtype('uint16')}.get(mode, numpy.dtype('uint8'))
+		bands = Image.getmodebands(mode)
+
+		if bands == 1:
+			return (header.size[1], header.size[0]), dtype
+
+		return (header.size[1], header.size[0], bands), dtype
+
+
+	@staticmethod
+	def writeImage(filename, img_arr):
+		""" Write image from an ndarray, nothing to do if img_arr is already
+			memory mapped to the .npy file
+		"""
+
+		with instrument.stats.timer("write"):
+
+			if not filename.endswith(".npy"):
+				misc.imsave(filename, img_arr)
+
+			elif isinstance(img_arr, numpy.memmap) and img_arr.filename is not None and os.path.abspath(img_arr.filename) == os.path.abspath(filename):
+				img_arr.flush()
+
+			else:
+				numpy.save(filename, img_arr)
+
+
+	@staticmethod
+	def sizedName(filename, patch_size):
+		""" Return filename with the patch size (px_width, px_height) added before the
+			extension (ex. out.png to out_3x3.png), for the outputs of a multi-size run
+		"""
+
+		root, extension = os.path.splitext(filename)
+
+		return "%s_%dx%d%s" % (root, patch_size[0], patch_size[1], extension)
+
+
 
 class PatchUtilities:
 	""" Additional functions useful when working with patches """
@@ -104,26 +184,99 @@ class Patch:
 		if a.pixels.shape != b.pixels.shape:
 			return 0.0
 
-		pixel_val_sum = 0.0
+		return float(Patch.comparePatchesBatch(a, b.pixels[numpy.newaxis])[0])
+
 
-		for y in range(a.pixels.shape[0]):
-			for x in range(a.pixels.shape[1]):
-				pixel_val_sum += Patch.comparePixels(a.pixels[y, x], b.pixels[y, x])
+	@staticmethod
+	def comparePatchesBatch(patch, candidates):
+		""" Compare patch against a stacked array of candidate pixels (N, px_height, px_width, channels)
+			in one operation, returning an array of N values equal to those of comparePatches
+			(0.0 for every candidate when the shapes do not match)
+		"""
+
+		candidates = numpy.asarray(candidates)
+
+		if candidates.shape[1:] != patch.pixels.shape:
+			return numpy.zeros(candidates.shape[0], dtype="float64")
+
+		return Patch.similarity(patch, Patch.distanceBatch(patch, candidates))
+
+
+	@staticmethod
+	def similarity(patch, distance):
+		""" Comparison value (0.0 to 1.0) of a distance (see distanceBatch) to patch, or an
+			array of them. Searches rank by distance and only convert the result.
+		"""
+
+		return 1.0 - (distance / float(patch.pixels.size * 255))
+
+
+	@staticmethod
+	def integerTypes(dtype):
+		""" Return (difference type, sum type) for pixels of dtype, the smallest signed types
+			holding the difference of two pixels and the sum of a patch of them: int16 and
+			int32 for uint8, so distances stay in compact types (patches of up to 8M values)
+		"""
+
+		dtype = numpy.dtype(dtype)
+
+		if dtype.itemsize == 1:
+			return numpy.dtype("int16"), numpy.dtype("int32")
 
-		return (pixel_val_sum / (a.pixels.shape[0] * a.pixels.shape[1]))
+		if dtype.itemsize == 2 and dtype.kind == "u":
+			return numpy.dtype("int32"), numpy.dtype("int64")
+
+		return numpy.dtype("int64"), numpy.dtype("int64")
+
+
+	@staticmethod
+	def distanceBatch(patch, candidates):
+		""" Sum of absolute differences between patch and each of the stacked candidate pixels
+			(N, px_height, px_width, channels) of the same shape, as an array of N ints
+			(a lower distance is a higher comparison value)
+		"""
+
+		instrument.stats.count("comparisons", candidates.shape[0])
+
+		diffType, sumType = Patch.integerTypes(candidates.dtype)
+		diff = candidates.astype(diffType) - patch.pixels.astype(diffType)
+
+		return numpy.abs(diff).reshape(candidates.shape[0], -1).sum(axis=1, dtype=sumType)
 
 
 	@staticmethod
 	def comparePixels(a, b):
 		""" Compare pixels based on avg of components raised to a power """
 
+		a = numpy.asarray(a)
+		diffType, sumType = Patch.integerTypes(a.dtype)
+		pixel_sum = numpy.abs(a.astype(diffType) - numpy.asarray(b).astype(diffType)).sum(dtype=sumType)
+
+		return 1.0 - (float(pixel_sum) / (len(a) * 255))
+
+
+	@staticmethod
+	def dihedral(pixels, k):
+		""" Return view of pixels rotated k % 4 times by 90 degrees, then flipped
+			left to right for k >= 4 (k in 0 to 7 gives the 8 rotations and flips)
+		"""
+
+		pixels = numpy.rot90(pixels, k % 4)
+
+		if k >= 4:
+			pixels = numpy.fliplr(pixels)
+
+		return pixels
 
-		pixel_sum = 0.0
 
-		for i in range(len(a)):
-			pixel_sum += abs(int(a[i]) - int(b[i]))
+	@staticmethod
+	def undoDihedral(pixels, k):
+		""" Return view of pixels with dihedral(pixels, k) undone """
+
+		if k >= 4:
+			pixels = numpy.fliplr(pixels)
 
-		return 1.0 - (pixel_sum / (len(a) * 255))
+		return numpy.rot90(pixels, -(k % 4))
 
 
 	@staticmethod
@@ -173,7 +326,13 @@ class PatchBounds:
 	def boundCopy(self, img):
 		""" Copy subsection of img specified by bounds """
 
-		return img[self.startPxRow:self.endPxRow, self.startPxCol:self.endPxCol].copy()
+		return self.boundView(img).copy()
+
+
+	def boundView(self, img):
+		""" View of subsection of img specified by bounds (no copy) """
+
+		return img[self.startPxRow:self.endPxRow, self.startPxCol:self.endPxCol]
 
 
 	def boundWrite(self, img_write, from_patch):
@@ -182,9 +341,7 @@ class PatchBounds:
 		if from_patch is None:
 			return
 
-		for y in range(self.startPxRow, self.endPxRow):
-			for x in range(self.startPxCol, self.endPxCol):
-				img_write[y, x] = from_patch.pixels[y - self.startPxRow, x - self.startPxCol]
+		self.boundView(img_write)[...] = from_patch.pixels
 
 
 
@@ -196,21 +353,99 @@ class BestPatch:
 		""" Get closest Patch to patch in samplePatches
 		"""
 
-		bestPatch = None
-		bestValue = -1.0
+		samplePatches.setPatchSize(patch)
+
+		# score every sample patch to find best patch to represent in
+		bestIndex, bestValue = samplePatches.getBestIndex(patch)
+
+		if bestIndex is None:
+			return None
+
+		return samplePatches.getPatch(bestIndex)
+
+
+	@staticmethod
+	def getBestPatchWithin(patch, samplePatches, distance):
+		""" Get closest Patch to patch in samplePatches as getBestPatch, if closer than
+			distance (see Patch.distanceBatch), otherwise None. The distance of a known
+			match bounds the search of techniques that prune.
+		"""
 
 		samplePatches.setPatchSize(patch)
 
-		# iterate over sample images to find best patch to represent in
-		for curr_patch in samplePatches:
+		bestIndex, bestValue = samplePatches.getBestIndexWithin(patch, distance)
+
+		if bestIndex is None:
+			return None
+
+		return samplePatches.getPatch(bestIndex)
+
+
+	@staticmethod
+	def augment(getBestPatch):
+		""" Return a getBestPatch(patch, samplePatches) that also searches with the patch
+			rotated and flipped (Patch.dihedral), and returns the best of the matches turned
+			back to the orientation of patch. Patches that aren't square need samples of the
+			swapped size for rotations by 90 degrees.
+		"""
+
+		def getBestPatchAugmented(patch, samplePatches):
+
+			bestPatch = None
+			bestValue = -1.0
+
+			for k in range(8):
+
+				foundPatch = getBestPatch(Patch(pixels=Patch.dihedral(patch.pixels, k)), samplePatches)
+
+				if foundPatch is None:
+					continue
+
+				# comparing in the orientation of patch gives the same value
+				currentPatch = Patch(pixels=Patch.undoDihedral(foundPatch.pixels, k))
+				currentValue = Patch.comparePatches(patch, currentPatch)
+
+				if currentValue > bestValue:
+					bestValue = currentValue
+					bestPatch = currentPatch
+
+			return bestPatch
+
+		return getBestPatchAugmented
+
+
+	@staticmethod
+	def memoize(getBestPatch, size, quantize=0):
+		""" Return a getBestPatch(patch, samplePatches) remembering the best patches found for
+			the last size distinct patches (least recently used forgotten first), so repeated
+			patches aren't searched again. Patches are told apart by their bytes, after dividing
+			their pixels by quantize when > 0 (nearly equal patches then share a match).
+			Counts memo_hits and memo_misses.
+		"""
+
+		memo = collections.OrderedDict()
+
+		def getBestPatchMemoized(patch, samplePatches):
+
+			pixels = patch.pixels if quantize <= 0 else patch.pixels // quantize
+			key = (pixels.shape, str(pixels.dtype), numpy.ascontiguousarray(pixels).tobytes())
+
+			if key in memo:
+				instrument.stats.count("memo_hits")
+				bestPatch = memo.pop(key)
+
+			else:
+				instrument.stats.count("memo_misses")
+				bestPatch = getBestPatch(patch, samplePatches)
+
+				if len(memo) >= size:
+					memo.popitem(last=False)
 
-			currentValue = Patch.comparePatches(patch, curr_patch)
+			memo[key] = bestPatch
 
-			if currentValue > bestValue:
-				bestValue = currentValue
-				bestPatch = curr_patch
+			return bestPatch
 
-		return bestPatch
+		return getBestPatchMemoized
 
 
 	@staticmethod
@@ -220,21 +455,48 @@ class BestPatch:
 			within sublistSamplePatches)
 		"""
 
-		bestPatch = None
-		bestValue = -1.0
-
 		sublistSamplePatches.setPatch(patch)
 
-		# iterate over sample images to find best patch to represent in
-		for curr_patch in sublistSamplePatches:
+		# score every patch in the sublist to find best patch to represent in
+		bestIndex, bestValue = sublistSamplePatches.getBestIndex(patch)
+
+		if bestIndex is None:
+			return None
+
+		return sublistSamplePatches.getPatch(bestIndex)
+
+
+	@staticmethod
+	def getBestIndex(patch, candidates):
+		""" Get (index, value) of the closest of the stacked candidate pixels
+			(N, px_height, px_width, channels) to patch, first one wins ties
+			and (None, -1.0) is returned when there are no candidates
+		"""
+
+		bestIndex, bestDistance = BestPatch.getBestDistance(patch, candidates)
+
+		if bestIndex is None:
+			return None, -1.0
+
+		return bestIndex, Patch.similarity(patch, bestDistance)
+
+
+	@staticmethod
+	def getBestDistance(patch, candidates):
+		""" Get (index, distance) of the closest of the stacked candidate pixels to patch, as
+			getBestIndex but with the integer distance (Patch.distanceBatch), and (None, None)
+			when there are no candidates or they don't match the shape of patch
+		"""
+
+		candidates = numpy.asarray(candidates)
 
-			currentValue = Patch.comparePatches(patch, curr_patch)
+		if len(candidates) == 0 or candidates.shape[1:] != patch.pixels.shape:
+			return None, None
 
-			if currentValue > bestValue:
-				bestValue = currentValue
-				bestPatch = curr_patch
+		distances = Patch.distanceBatch(patch, candidates)
+		bestIndex = int(numpy.argmin(distances))
 
-		return bestPatch
+		return bestIndex, int(distances[bestIndex])
 
 
 
@@ -264,6 +526,17 @@ class SplitPatchInfo:
 		return str(self.numPatches) + " " + str(self.patchRows) + " " + str(self.patchCols)
 
 
+	def patchSizes(self):
+		""" Return list of the distinct patch sizes (px_width, px_height) in the split,
+			the general size and the smaller sizes of patches on the right and bottom edges
+		"""
+
+		widths = set([self.general_patch_size[0], self.img.shape[1] - (self.patchCols - 1) * self.general_patch_size[0]])
+		heights = set([self.general_patch_size[1], self.img.shape[0] - (self.patchRows - 1) * self.general_patch_size[1]])
+
+		return [(width, height) for height in sorted(heights) for width in sorted(widths)]
+
+
 	def __iter__(self):
 		""" Iterator - iterates over patches """
 		return self
@@ -292,318 +565,623 @@ class SplitPatchInfo:
 		bounds.endPxCol = PatchUtilities.upperBound(bounds.startPxCol + self.general_patch_size[0], self.img.shape[1])
 
 
-		# get pixels in current patch
-		self.currentPatch = Patch(pixels=bounds.boundCopy(self.img))
+		# get pixels in current patch (a view, source patches are only read)
+		self.currentPatch = Patch(pixels=bounds.boundView(self.img))
 
 		return self.currentPatch, bounds
 
 
 
-class SamplePatches:
-	""" A way of consolidating how sample patches are generated and managed """
+class OverlapPatchInfo:
+	""" Patch information for an image where patches of the same size overlap, their upper
+		left corners stride pixels apart (the last row and column of patches moved in to end
+		at the edge of the image), to be blended together with PatchBlend
+	"""
 
-	def __init__(self, img_set, img_read):
+	def __init__(self, img_read, patch_size, stride):
 		""" Constructor """
 
-		self.imgSet = img_set
-		self.imgRead = img_read
-		self.samplePatches = {}
+		self.img = img_read
+		self.general_patch_size = patch_size
+		self.stride = stride
 
-		self.iter_patch_size = (0, 0)
-		self.iter_counter = -1
-		self.iter_max = 0
+		self.rowPositions = OverlapPatchInfo.axisPositions(img_read.shape[0], patch_size[1], stride)
+		self.colPositions = OverlapPatchInfo.axisPositions(img_read.shape[1], patch_size[0], stride)
 
+		self.patchRows = len(self.rowPositions)
+		self.patchCols = len(self.colPositions)
+		self.numPatches = self.patchRows * self.patchCols
 
-	def generate(self, source_patch):
-		""" Generate sample patches if needed.
-			Returns number of sample patches matching 
-			patch size of source patch.
-		"""
 
-		self.iter_patch_size = source_patch.getPatchSize()
-		currKey = self.iter_patch_size
+	def __str__(self):
+		""" Print """
+		return str(self.numPatches) + " " + str(self.patchRows) + " " + str(self.patchCols)
 
-		if currKey in self.samplePatches:
-			return self.numPatches(currKey)
 
+	@staticmethod
+	def axisPositions(length, size, stride):
+		""" Return the start of every patch of size along an axis of length, stride apart
+			and the last ending at length
+		"""
 
-		self.initPatches(currKey)
+		positions = range(0, max(length - size, 0) + 1, stride)
 
-		print "Creating samples ", currKey
+		if positions[-1] + size < length:
+			positions.append(length - size)
 
-		# Construct patches
-		for sampleImg in self.imgSet.samples:
+		return positions
 
-			print sampleImg
-			
-			sampleImgRead = misc.imread(sampleImg)
 
-			# doesn't match how pixels are encoded, move on
-			if (sampleImgRead.shape[2] != self.imgRead.shape[2] or sampleImgRead.dtype != self.imgRead.dtype):
-				continue
+	def positions(self, startPatchRow=0, endPatchRow=None):
+		""" Return (N, 2) array of the (y, x) upper left corners of the patches in the patch rows
+			from startPatchRow to endPatchRow, in row order
+		"""
 
-			# iterate over pixels, act as upper left corner of patch
-			for y in range(sampleImgRead.shape[0] - (self.iter_patch_size[1] - 1)):
+		ys, xs = numpy.meshgrid(self.rowPositions[startPatchRow:endPatchRow], self.colPositions, indexing="ij")
 
-				for x in range(sampleImgRead.shape[1] - (self.iter_patch_size[0] - 1)):
+		return numpy.column_stack((ys.ravel(), xs.ravel()))
 
-					samplePatch = Patch(pixels=sampleImgRead[y:(y + self.iter_patch_size[1]), x:(x + self.iter_patch_size[0])])
-					self.addPatch(currKey, samplePatch)
 
-					# get rotated and flipped patches as well
-					# permutedPatches = Patch.permute(samplePatch)
-					# self.addPatch(currKey, permutedPatches)
+	def patches(self, positions):
+		""" Return the source patches at positions as one (N, px_height, px_width, channels) view """
 
+		view = as_strided(self.img,
+			shape=(self.img.shape[0] - self.general_patch_size[1] + 1, self.img.shape[1] - self.general_patch_size[0] + 1, self.general_patch_size[1], self.general_patch_size[0], self.img.shape[2]),
+			strides=(self.img.strides[0], self.img.strides[1]) + self.img.strides,
+			writeable=False)
 
-		return self.numPatches(currKey)
+		return view[positions[:, 0], positions[:, 1]]
 
 
-	def initPatches(self, key):
-		""" Initialize value for dictionary to be associated with current key """
 
-		self.samplePatches[key] = []
+class PatchBlend:
+	""" Accumulate overlapping patches into float sum and weight buffers, then normalize
+		once into the blended image. Each patch pixel is weighted the same (uniform) or
+		less towards the patch edges (feather), which hides the seams between patches.
+	"""
 
+	def __init__(self, shape, patch_size, feather=True):
+		""" Constructor """
 
-	def addPatch(self, key, patch):
-		""" Add sample to list of samples for key """
+		self.sum = numpy.zeros(shape, dtype="float64")
+		self.weight = numpy.zeros(shape[:2], dtype="float64")
 
-		if isinstance(patch, list):
-			self.samplePatches[key].extend(patch)
+		if feather:
+			# tent highest in the middle of the patch, never 0 so every pixel is covered
+			weightY = numpy.minimum(numpy.arange(1, patch_size[1] + 1), numpy.arange(patch_size[1], 0, -1))
+			weightX = numpy.minimum(numpy.arange(1, patch_size[0] + 1), numpy.arange(patch_size[0], 0, -1))
+			self.mask = numpy.outer(weightY, weightX).astype("float64")
 		else:
-			self.samplePatches[key].append(patch)
-
-
-	def numPatches(self, key):
-		""" Return number of patches associated with key """
-
-		return len(self.samplePatches[key])
+			self.mask = numpy.ones((patch_size[1], patch_size[0]), dtype="float64")
 
 
-	def setPatchSize(self, source_patch):
-		""" Pass in a patch to specify patch size for sample patch generation and 
-			then this is usable for iteration 
+	def add(self, positions, pixels):
+		""" Add patches pixels (N, px_height, px_width, channels) with upper left corners at
+			positions (N, 2) to the buffers, all at once
 		"""
 
-		self.iter_counter = -1
-		self.iter_max = self.generate(source_patch)
+		if len(positions) == 0:
+			return
 
+		offsetY, offsetX = numpy.indices(self.mask.shape)
+		ys = positions[:, 0, numpy.newaxis, numpy.newaxis] + offsetY
+		xs = positions[:, 1, numpy.newaxis, numpy.newaxis] + offsetX
 
-	def __iter__(self):
-		""" Iterator - iterate over sample patches with patch size set using setPatchSize """
-		return self
+		# add.at as patches overlap, so the same pixel can appear several times
+		numpy.add.at(self.sum, (ys, xs), pixels * self.mask[..., numpy.newaxis])
+		numpy.add.at(self.weight, (ys, xs), numpy.broadcast_to(self.mask, ys.shape))
 
 
-	def next(self):
-		""" Grab next patch with patch size specified """
+	def result(self, dtype):
+		""" Return the blended image as dtype, 0 where no patch was added """
 
-		self.iter_counter += 1
+		weight = numpy.where(self.weight > 0, self.weight, 1.0)[..., numpy.newaxis]
 
-		if self.iter_counter >= self.iter_max:
-			self.iter_counter = -1
-			raise StopIteration
+		return numpy.rint(self.sum / weight).astype(dtype)
 
-		return self.samplePatches[self.iter_patch_size][self.iter_counter]
 
 
+class PatchStore:
+	""" Compact store of every sample patch of one size. Patches are kept as strided
+		window views (rows, cols, px_height, px_width, channels) over the sample
+		images instead of one Patch per position, and are indexed by integer in
+		sample, row, column order.
+	"""
 
-# $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $
-# $ Sublist Sample Patches  $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $
+	batch_size = 4096
 
-class PatchSublist:
-	""" A sublist of patches that can be categorized by a patch constructed of their average
-	"""
 
-	def __init__(self, initialPatch):
+	def __init__(self, patch_size):
 		""" Constructor """
 
-		self.patches = [initialPatch]
-		self.patch_size = initialPatch.getPatchSize()
+		self.patch_size = patch_size
+		self.images = []
+		self.views = []
+		self.steps = []
+		self.offsets = [0]
 
-		self.patch_sum = numpy.zeros(initialPatch.pixels.shape, dtype="uint64")
-		self.addToSum(initialPatch)
 
-		self.avg = Patch(pixels=initialPatch.pixels.copy())
-		self.valid_avg = True
+	def addImage(self, img_arr, step=1):
+		""" Add every patch of img_arr (each pixel as upper left corner, or every step
+			pixels in both directions) to the store. Returns number of patches added.
+		"""
 
+		rows = img_arr.shape[0] - (self.patch_size[1] - 1)
+		cols = img_arr.shape[1] - (self.patch_size[0] - 1)
 
-	def addToSum(self, patch):
-		""" Add patch to patch_sum """
+		if rows <= 0 or cols <= 0:
+			return 0
 
-		if self.patch_sum.shape != patch.pixels.shape:
-			print "Invalid patch shape to add to PatchSublist"
-			return
+		rows = (rows + step - 1) // step
+		cols = (cols + step - 1) // step
 
-		for y in range(0, self.patch_sum.shape[0]):
-			for x in range(0, self.patch_sum.shape[1]):
-				for z in range(0, self.patch_sum.shape[2]):
-					self.patch_sum[y, x, z] += patch.pixels[y, x, z]
+		view = as_strided(img_arr,
+			shape=(rows, cols, self.patch_size[1], self.patch_size[0], img_arr.shape[2]),
+			strides=(img_arr.strides[0] * step, img_arr.strides[1] * step, img_arr.strides[0], img_arr.strides[1], img_arr.strides[2]),
+			writeable=False)
 
-		# Invalidate average
-		self.valid_avg = False
+		self.images.append(img_arr)
+		self.views.append(view)
+		self.steps.append(step)
+		self.offsets.append(self.offsets[-1] + rows * cols)
 
+		return rows * cols
 
-	def constructAvg(self):
-		""" Construct the average for the sublist using the patch_sum """
 
-		for y in range(0, self.avg.pixels.shape[0]):
-			for x in range(0, self.avg.pixels.shape[1]):
-				for z in range(0, self.avg.pixels.shape[2]):
-					self.avg.pixels[y, x, z] = (self.patch_sum[y, x, z] / self.__len__())
+	def addPatches(self, pixels):
+		""" Add stacked patches (N, px_height, px_width, channels) to the store, kept as
+			a single column of patches. Returns number of patches added.
+		"""
 
-		self.valid_avg = True
+		if len(pixels) == 0:
+			return 0
 
+		self.images.append(pixels)
+		self.views.append(pixels.reshape((len(pixels), 1) + pixels.shape[1:]))
+		self.steps.append(1)
+		self.offsets.append(self.offsets[-1] + len(pixels))
 
-	def getAvg(self):
-		""" Get average patch of those represented by the sublist """
+		return len(pixels)
 
-		# Construct average if needed
-		if not self.valid_avg:
-			self.constructAvg()
 
-		return self.avg
+	def locate(self, index):
+		""" Return (image index, y, x) of the upper left corner of patch index """
 
-	def add(self, patch):
-		""" Add patch to sublist """
+		if index < 0 or index >= len(self):
+			raise IndexError("PatchStore index out of range")
 
-		if self.patch_size != patch.getPatchSize():
-			print "Patch size does not match, can't add to PatchSublist"
-			return False
+		imageIndex = bisect.bisect_right(self.offsets, index) - 1
+		y, x = divmod(index - self.offsets[imageIndex], self.views[imageIndex].shape[1])
+		step = self.steps[imageIndex]
 
-		self.patches.append(patch)
-		self.addToSum(patch)
+		return imageIndex, y * step, x * step
 
-		return True
 
+	def indexOf(self, imageIndex, y, x):
+		""" Return patch index of the patch with upper left corner (y, x) in image imageIndex
+			(on the step the image was added with)
+		"""
 
-	def __len__(self):
-		""" Length of sublist """
-		return len(self.patches)
+		step = self.steps[imageIndex]
 
+		return self.offsets[imageIndex] + (y // step) * self.views[imageIndex].shape[1] + x // step
 
 
-class PatchSublistManager:
-	""" Manager of patch sublists to allow matching of samples for better organization
-		based on sample patch comparisons. If best comparison between patch and the average
-		of each sublist is greater than or equal to the threshold, then add it to that
-		sublist, else, create a new sublist.
-	"""
+	def take(self, indices):
+		""" Return the pixels of the patches at indices as one (N, px_height, px_width, channels) array """
 
-	def __init__(self, thresholdValue):
-		""" Constructor"""
+		indices = numpy.asarray(indices, dtype="int64")
 
-		if thresholdValue < 0 or thresholdValue > 1:
-			print "thresholdValue in PatchSublistManager should be in range [0, 1]"
+		if len(indices) == 0 or len(self.views) == 0:
+			return numpy.zeros((0, self.patch_size[1], self.patch_size[0], 0), dtype="uint8")
 
-		self.sublists = []
-		self.threshold = thresholdValue
-		self.numPatches = 0
+		out = numpy.empty((len(indices), ) + self.views[0].shape[2:], dtype=self.views[0].dtype)
 
+		imageIndices = numpy.searchsorted(self.offsets, indices, side="right") - 1
 
-	def numSublists(self):
-		""" Return the number of sublists """
+		for imageIndex in numpy.unique(imageIndices):
+			mask = (imageIndices == imageIndex)
+			view = self.views[imageIndex]
+			y, x = numpy.divmod(indices[mask] - self.offsets[imageIndex], view.shape[1])
+			out[mask] = view[y, x]
 
-		return len(self.sublists)
+		return out
 
 
-	def addPatch(self, patch):
-		""" Add patch to sublist with best comparison value greater than or equal
-			to the threshold or create new sublist
+	def batches(self):
+		""" Generator of (start index, stacked pixels) covering the store in order,
+			each holding roughly batch_size patches
 		"""
 
-		bestSublist = self.getBestSublist(patch, thresholdCheck=True)
+		for imageIndex, view in enumerate(self.views):
 
-		# either add new sublist or add to sublist
-		if bestSublist is None:
-			self.sublists.append(PatchSublist(patch))
-		else:
-			bestSublist.add(patch)
+			rowsPerBatch = max(1, self.batch_size // view.shape[1])
 
-		self.numPatches += 1
+			for row in range(0, view.shape[0], rowsPerBatch):
+				batch = view[row:(row + rowsPerBatch)]
+				yield (self.offsets[imageIndex] + row * view.shape[1]), batch.reshape((-1, ) + view.shape[2:])
 
 
-	def getBestSublist(self, patch, thresholdCheck=False):
-		""" Get the best sublist match for this patch if greater than or equal to
-			threshold
-		"""
+	def vectors(self):
+		""" Return every patch in the store flattened into one (N, px_height * px_width * channels) array """
 
-		bestSublist = None
-		bestValue = -1.0
+		if len(self.views) == 0:
+			return numpy.zeros((0, 0), dtype="uint8")
 
-		# iterate over sublists to find best sublist for the patch
-		for currSublist in self.sublists:
+		return numpy.concatenate([batch.reshape(len(batch), -1) for start, batch in self.batches()])
 
-			currentValue = Patch.comparePatches(patch, currSublist.getAvg())
 
-			if currentValue > bestValue:
-				bestValue = currentValue
-				bestSublist = currSublist
+	def getBestIndex(self, patch):
+		""" Get (index, value) of the closest patch in the store to patch """
 
+		bestIndex = None
+		bestDistance = None
 
-		# check threshold
-		if thresholdCheck and bestValue < self.threshold:
-			return None
+		for start, batch in self.batches():
+
+			currentIndex, currentDistance = BestPatch.getBestDistance(patch, batch)
 
-		return bestSublist
+			if currentIndex is None:
+				continue
 
+			if bestDistance is None or currentDistance < bestDistance:
+				bestDistance = currentDistance
+				bestIndex = start + currentIndex
 
-	def getAllPatches(self):
-		""" Get a list of all patches contained by manager """
+		if bestIndex is None:
+			return None, -1.0
 
-		patches = []
+		return bestIndex, Patch.similarity(patch, bestDistance)
 
-		for sublist in self.sublists:
-			patches.extend(sublist.patches)
 
-		return patches
+	def __getitem__(self, index):
+		""" Pixels of patch index (a view onto the sample image) """
+
+		imageIndex, y, x = self.locate(index)
+		step = self.steps[imageIndex]
+
+		return self.views[imageIndex][y // step, x // step]
 
 
 	def __len__(self):
-		""" Return number of patches stored in the manager """
+		""" Number of patches in the store """
 
-		return self.numPatches
+		return self.offsets[-1]
 
 
 
-class SublistSamplePatches(SamplePatches):
-	""" Extension of Sample Patches where patches are organized into sublists 
-		organized by how well those patches match the average of each sublist.
-		If the best match is greater than or equal to a threshold, appends to
-		sublist, else, a new sublist is created.
+class PatchSampling:
+	""" Which patches of the sample images become sample patches. Patches are taken every
+		stride pixels, of those a fraction at random, and with a budget > 0 at most that
+		many patches over all the sample images. The budget is spread evenly over the
+		images, with what an image can't use passed on to the ones after it.
 	"""
 
-	def __init__(self, img_set, img_read, thresholdValue):
+	def __init__(self, stride=1, fraction=1.0, budget=0, seed=0):
 		""" Constructor """
 
-		SamplePatches.__init__(self, img_set, img_read)
-		self.threshold = thresholdValue
+		self.stride = stride
+		self.fraction = fraction
+		self.budget = budget
+		self.seed = seed
 
+		self.random = None
+		self.remaining = 0
+		self.imagesLeft = 0
 
-	def generate(self, source_patch):
 
-		displayGenerateMsg = (not source_patch.getPatchSize() in self.samplePatches)
+	def key(self):
+		""" Return the options as a tuple, for cache keys """
 
-		num = SamplePatches.generate(self, source_patch)
+		return (self.stride, self.fraction, self.budget, self.seed)
 
-		if displayGenerateMsg:
-			print "%d sublists generated in SublistPatchManager for a threshold of %.3f" % (self.samplePatches[self.iter_patch_size].numSublists(), self.threshold)
 
-		return num
+	def isDense(self):
+		""" Return whether every patch is taken """
+
+		return self.stride <= 1 and self.fraction >= 1.0 and self.budget <= 0
+
+
+	def start(self, num_samples):
+		""" Start sampling num_samples sample images (same random choices every time) """
+
+		self.random = numpy.random.RandomState(self.seed)
+		self.remaining = self.budget
+		self.imagesLeft = num_samples
+
+
+	def select(self, count):
+		""" Return the sorted indices of the patches to take of the next image's count
+			patches on the stride, None for all of them
+		"""
+
+		take = count
+
+		if self.fraction < 1.0:
+			take = int(round(count * self.fraction))
+
+		if self.budget > 0:
+			take = min(take, self.remaining // max(self.imagesLeft, 1))
+			self.remaining -= take
+
+		self.imagesLeft -= 1
+
+		if take >= count:
+			return None
+
+		return numpy.sort(self.random.choice(count, take, replace=False))
+
+
+
+class SamplePatches:
+	""" A way of consolidating how sample patches are generated and managed.
+		With a cache (cache.SampleCache), decoded sample images are saved on the
+		first run and loaded memory mapped on the next.
+		With dedup > 0, patches are quantized by dividing their pixels by dedup and only
+		the first patch of each quantized value is kept, along with how many patches it
+		stands for (dedup of 1 drops exact duplicates only, which doesn't change results).
+		A PatchSampling limits which patches are taken in the first place.
+		Sample images are decoded by decode_threads threads, ahead of the patches being
+		added from the images already decoded, and only once for all the patch sizes.
+	"""
+
+	decode_threads = 4
+
+
+	def __init__(self, img_set, img_read, cache=None, dedup=0, sampling=None):
+		""" Constructor """
+
+		self.imgSet = img_set
+		self.imgRead = img_read
+		self.cache = cache
+		self.dedup = dedup
+		self.sampling = sampling if sampling is not None else PatchSampling()
+		self.validSamples = None
+		self.sampleImgs = None
+		self.samplePatches = {}
+
+		# quantized patch bytes to store index while generating, patches each stands for
+		self.dedupTables = {}
+		self.patchCounts = {}
+
+		self.iter_patch_size = (0, 0)
+		self.iter_list = None
+		self.iter_counter = -1
+		self.iter_max = 0
+
+
+	def generate(self, source_patch):
+		""" Generate sample patches if needed.
+			Returns number of sample patches matching 
+			patch size of source patch.
+		"""
+
+		self.iter_patch_size = source_patch.getPatchSize()
+		currKey = self.iter_patch_size
+
+		if currKey in self.samplePatches:
+			return self.numPatches(currKey)
+
+
+		self.initPatches(currKey)
+
+		print "Creating samples ", currKey
+
+		with instrument.stats.timer("generate"):
+
+			if not self.loadPatches(currKey):
+
+				# Construct patches
+				self.sampling.start(len(self.getValidSamples()))
+
+				for sampleImgRead in self.readSamples():
+
+					# every pixel acts as upper left corner of a patch
+					self.addSample(currKey, sampleImgRead)
+
+				self.savePatches(currKey)
+
+		if self.dedup > 0:
+			print "%d of %d sample patches kept" % (self.numPatches(currKey), sum(self.patchCounts.get(currKey, [])))
+			self.dedupTables.pop(currKey, None)
+
+		elif not self.sampling.isDense():
+			print "%d sample patches taken" % (self.numPatches(currKey), )
+
+
+		return self.numPatches(currKey)
+
+
+	def generateSize(self, size):
+		""" Generate sample patches of size (px_width, px_height) if needed, as generate does
+			for a source patch of that size. Returns number of sample patches of the size.
+		"""
+
+		return self.generate(Patch(pixels=numpy.zeros((size[1], size[0], self.imgRead.shape[2]), dtype=self.imgRead.dtype)))
+
+
+	def getValidSamples(self):
+		""" Return list of the sample images that match how pixels are encoded in the source,
+			checked from their headers before any are decoded
+		"""
+
+		if self.validSamples is None:
+
+			self.validSamples = []
+
+			for sampleImg in self.imgSet.samples:
+
+				try:
+					shape, dtype = ImgSet.readHeader(sampleImg)
+				except (IOError, ValueError):
+					print "Skipping unreadable sample", sampleImg
+					continue
+
+				# patches are compared as integers
+				if dtype.kind not in "ui":
+					print "Skipping sample without integer pixels", sampleImg
+					continue
+
+				# doesn't match how pixels are encoded, move on
+				if len(shape) != 3 or shape[2] != self.imgRead.shape[2] or dtype != self.imgRead.dtype:
+					print "Skipping sample not encoded like the source", sampleImg
+					continue
+
+				self.validSamples.append(sampleImg)
+
+		return self.validSamples
+
+
+	def readSamples(self):
+		""" Return the decoded valid sample images in order. They are decoded (or loaded from
+			the cache) the first time and kept for the other patch sizes, which then share
+			them instead of decoding again. Returns a list, or an iterator the first time
+			when decoding without a cache.
+		"""
+
+		if self.sampleImgs is not None:
+			return self.sampleImgs
+
+		if self.cache is None:
+			return self.keepSamples(self.decodeSamples(self.getValidSamples()))
+
+		cacheKey = self.cache.entryKey("samples", self.cache.fingerprint(self.imgSet.samples), self.imgRead.shape[2], str(self.imgRead.dtype))
+		cached = self.cache.load(cacheKey)
+
+		if cached is None:
+			sampleImgs = list(self.decodeSamples(self.getValidSamples()))
+			cached = self.cache.save(cacheKey, dict(("image_%06d" % (i, ), sampleImgRead) for i, sampleImgRead in enumerate(sampleImgs)))
+
+		self.sampleImgs = [cached[name] for name in sorted(cached.keys())]
+
+		return self.sampleImgs
+
+
+	def keepSamples(self, sample_imgs):
+		""" Generator passing on the sample images of the iterator sample_imgs, kept once all
+			have been passed on
+		"""
+
+		sampleImgs = []
+
+		for sampleImgRead in sample_imgs:
+			sampleImgs.append(sampleImgRead)
+			yield sampleImgRead
+
+		self.sampleImgs = sampleImgs
+
+
+	def decodeSamples(self, sample_files):
+		""" Generator of the images of sample_files in order, decoded by a pool of threads
+			running ahead of the consumer (decoding mostly runs outside the GIL)
+		"""
+
+		if len(sample_files) == 0:
+			return
+
+		pool = ThreadPool(max(1, min(self.decode_threads, len(sample_files))))
+
+		try:
+			for index, sampleImgRead in enumerate(pool.imap(ImgSet.readImage, sample_files)):
+				print sample_files[index]
+				yield sampleImgRead
+
+		finally:
+			pool.terminate()
+			pool.join()
+
+
+	def loadPatches(self, key):
+		""" Load generated patches for key from the cache, returns whether they were loaded
+			(sample patches are views on the sample images, which readSamples caches)
+		"""
+
+		return False
+
+
+	def savePatches(self, key):
+		""" Save generated patches for key to the cache """
+
+		pass
 
 
 	def initPatches(self, key):
 		""" Initialize value for dictionary to be associated with current key """
 
-		self.samplePatches[key] = PatchSublistManager(self.threshold)
+		self.samplePatches[key] = PatchStore(key)
 
 
-	def addPatch(self, key, patch):
-		""" Add sample to list of samples """
+	def addSample(self, key, sample_img):
+		""" Add every patch of the sample image to the samples for key """
 
-		if isinstance(patch, list):
-			for curr_patch in patch:
-				self.samplePatches[key].addPatch(curr_patch)
-		else:
-			self.samplePatches[key].addPatch(patch)
+		self.addToStore(self.samplePatches[key], key, sample_img)
+
+
+	def addToStore(self, store, key, sample_img):
+		""" Add the patches of the sample image chosen by the sampling to store, only those
+			not yet represented with dedup
+		"""
+
+		windows = PatchStore(key)
+		windows.addImage(sample_img, self.sampling.stride)
+
+		positions = self.sampling.select(len(windows))
+
+		# views onto the image when every patch on the stride is kept
+		if positions is None and self.dedup <= 0:
+			store.addImage(sample_img, self.sampling.stride)
+			return
+
+		if positions is None:
+			positions = numpy.arange(len(windows))
+
+		pixels = windows.take(positions)
+
+		if self.dedup > 0:
+			pixels = self.uniquePatches(store, key, pixels)
+
+		store.addPatches(pixels)
+
+
+	def uniquePatches(self, store, key, pixels):
+		""" Return the patches of pixels (N, px_height, px_width, channels) whose quantized
+			value isn't yet in store, counting the others towards the patch that represents them
+		"""
+
+		if len(pixels) == 0:
+			return pixels
+
+		vectors = pixels.reshape(len(pixels), -1)
+		quantized = numpy.ascontiguousarray(vectors // self.dedup)
+
+		# unique quantized patches within the image, in order of first appearance
+		rows = quantized.view(numpy.dtype((numpy.void, quantized.shape[1] * quantized.itemsize))).ravel()
+		unique, first, counts = numpy.unique(rows, return_index=True, return_counts=True)
+		order = numpy.argsort(first)
+
+		table = self.dedupTables.setdefault(key, {})
+		patchCounts = self.patchCounts.setdefault(key, [])
+		keep = []
+
+		# then against the patches already kept
+		for uniqueIndex in order:
+
+			bucket = quantized[first[uniqueIndex]].tobytes()
+
+			if bucket in table:
+				patchCounts[table[bucket]] += int(counts[uniqueIndex])
+			else:
+				table[bucket] = len(store) + len(keep)
+				patchCounts.append(int(counts[uniqueIndex]))
+				keep.append(first[uniqueIndex])
+
+		return pixels[keep]
+
+
+	def getStore(self, key):
+		""" Return the PatchStore holding the sample patches for key """
+
+		return self.samplePatches[key]
 
 
 	def numPatches(self, key):
@@ -612,29 +1190,55 @@ class SublistSamplePatches(SamplePatches):
 		return len(self.samplePatches[key])
 
 
-	def setPatch(self, source_patch):
-		""" Pass in a patch to get best patch sublist from sample patch generation 
-			(perform if needed) and then this is usable for iteration on that sublist
+	def setPatchSize(self, source_patch):
+		""" Pass in a patch to specify patch size for sample patch generation and 
+			then this is usable for iteration 
 		"""
 
 		self.iter_counter = -1
+		self.iter_list = None
+		self.iter_max = self.generate(source_patch)
 
-		# generate and then grab sublist that matches
-		self.generate(source_patch)
-		self.iter_list = self.samplePatches[self.iter_patch_size].getBestSublist(source_patch)
-		self.iter_max = len(self.iter_list)
 
+	def storeIndex(self, index):
+		""" Map an index in the current iteration to an index in the store """
 
-	def setPatchSize(self, source_patch):
-		""" Pass in a patch to specify patch size for sample patch generation and 
-			then this is usable for iteration (iterates over all, same as linear)
+		if self.iter_list is None:
+			return index
+
+		return int(self.iter_list[index])
+
+
+	def getPatch(self, index):
+		""" Get patch index of the current iteration """
+
+		return Patch(pixels=self.getStore(self.iter_patch_size)[self.storeIndex(index)])
+
+
+	def getBestIndex(self, patch):
+		""" Get (index, value) of the closest patch to patch in the current iteration """
+
+		store = self.getStore(self.iter_patch_size)
+		instrument.stats.count("candidates", self.iter_max)
+
+		if self.iter_list is None:
+			return store.getBestIndex(patch)
+
+		return BestPatch.getBestIndex(patch, store.take(self.iter_list))
+
+
+	def getBestIndexWithin(self, patch, distance):
+		""" Get (index, value) of the closest patch to patch as getBestIndex, if its distance
+			(see Patch.distanceBatch) is less than distance, otherwise (None, -1.0).
+			Techniques that can prune their search by the distance override this.
 		"""
 
-		self.iter_counter = -1
+		bestIndex, bestValue = self.getBestIndex(patch)
 
-		# generate and then grab sublist that matches
-		self.iter_max = self.generate(source_patch)
-		self.iter_list = self.samplePatches[self.iter_patch_size].getAllPatches()
+		if bestIndex is None or bestValue <= Patch.similarity(patch, distance):
+			return None, -1.0
+
+		return bestIndex, bestValue
 
 
 	def __iter__(self):
@@ -651,4 +1255,1040 @@ class SublistSamplePatches(SamplePatches):
 			self.iter_counter = -1
 			raise StopIteration
 
-		return self.iter_list.patches[self.iter_counter]
\ No newline at end of file
+		return self.getPatch(self.iter_counter)
+
+
+
+# $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $
+# $ Sublist Sample Patches  $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $ $
+
+class PatchSublist:
+	""" A sublist of patches that can be categorized by a patch constructed of their average.
+		Patches are held as indices into a PatchStore, in an int64 array grown by doubling
+		(or a view of the indices of every sublist once packed, see PatchSublistManager.pack).
+	"""
+
+	def __init__(self, store, initialIndex):
+		""" Constructor """
+
+		initialPatch = Patch(pixels=store[initialIndex])
+
+		self.store = store
+		self.indices = numpy.empty(4, dtype="int64")
+		self.indices[0] = initialIndex
+		self.numIndices = 1
+		self.patch_size = initialPatch.getPatchSize()
+
+		self.patch_sum = numpy.zeros(initialPatch.pixels.shape, dtype=Patch.integerTypes(initialPatch.pixels.dtype)[1])
+		self.sum_limit = numpy.iinfo(self.patch_sum.dtype).max // (255 if initialPatch.pixels.dtype.itemsize == 1 else 65535)
+		self.addToSum(initialPatch)
+
+		self.avg = Patch(pixels=initialPatch.pixels.copy())
+		self.valid_avg = True
+
+
+	def setState(self, indices, patch_sum):
+		""" Replace the patches of the sublist with the int64 array indices (kept, not copied)
+			given the sum of their pixels
+		"""
+
+		self.indices = indices
+		self.numIndices = len(indices)
+		self.widenSum()
+		self.patch_sum[...] = patch_sum
+		self.valid_avg = False
+
+
+	def widenSum(self):
+		""" Hold patch_sum as int64 once the sublist has too many patches for its type """
+
+		if self.numIndices > self.sum_limit:
+			self.patch_sum = self.patch_sum.astype("int64")
+			self.sum_limit = numpy.iinfo("int64").max // 65535
+
+
+	def addToSum(self, patch):
+		""" Add patch to patch_sum """
+
+		if self.patch_sum.shape != patch.pixels.shape:
+			print "Invalid patch shape to add to PatchSublist"
+			return
+
+		self.widenSum()
+		self.patch_sum += patch.pixels
+
+		# Invalidate average
+		self.valid_avg = False
+
+
+	def constructAvg(self):
+		""" Construct the average for the sublist using the patch_sum """
+
+		self.avg.pixels[...] = self.patch_sum // self.__len__()
+
+		self.valid_avg = True
+
+
+	def getAvg(self):
+		""" Get average patch of those represented by the sublist """
+
+		# Construct average if needed
+		if not self.valid_avg:
+			self.constructAvg()
+
+		return self.avg
+
+
+	def getIndices(self):
+		""" Get the store indices of the patches of the sublist (a view) """
+
+		return self.indices[:self.numIndices]
+
+
+	def reserve(self, count):
+		""" Make room for count more indices, doubling the array when it is full """
+
+		if self.numIndices + count > len(self.indices):
+
+			indices = numpy.empty(max(2 * len(self.indices), self.numIndices + count), dtype="int64")
+			indices[:self.numIndices] = self.indices[:self.numIndices]
+			self.indices = indices
+
+
+	def add(self, index):
+		""" Add patch index of the store to sublist """
+
+		patch = Patch(pixels=self.store[index])
+
+		if self.patch_size != patch.getPatchSize():
+			print "Patch size does not match, can't add to PatchSublist"
+			return False
+
+		self.reserve(1)
+		self.indices[self.numIndices] = index
+		self.numIndices += 1
+		self.addToSum(patch)
+
+		return True
+
+
+	def addBatch(self, indices, pixels_sum):
+		""" Add patch indices of the store to sublist given the sum of their pixels """
+
+		if self.patch_sum.shape != pixels_sum.shape:
+			print "Invalid patch shape to add to PatchSublist"
+			return False
+
+		self.reserve(len(indices))
+		self.indices[self.numIndices:(self.numIndices + len(indices))] = indices
+		self.numIndices += len(indices)
+		self.widenSum()
+		self.patch_sum += pixels_sum
+
+		# Invalidate average
+		self.valid_avg = False
+
+		return True
+
+
+	def __len__(self):
+		""" Length of sublist """
+		return self.numIndices
+
+
+
+class PatchSublistManager:
+	""" Manager of patch sublists to allow matching of samples for better organization
+		based on sample patch comparisons. If best comparison between patch and the average
+		of each sublist is greater than or equal to the threshold, then add it to that
+		sublist, else, create a new sublist.
+
+		The averages of the sublists are kept as rows of one centroid matrix so a patch
+		is compared against all of them in a single operation. With a batchSize greater
+		than 0, patches are added in mini-batches: every patch of a batch is compared to
+		the averages as they were at the start of the batch and those meeting the threshold
+		are added together, the rest are then added one at a time as usual (so new sublists
+		form the same way). This is much faster to build but sublists can differ slightly
+		from adding patches one at a time.
+	"""
+
+	def __init__(self, thresholdValue, store, batchSize=0):
+		""" Constructor"""
+
+		if thresholdValue < 0 or thresholdValue > 1:
+			print "thresholdValue in PatchSublistManager should be in range [0, 1]"
+
+		self.store = store
+		self.sublists = []
+		self.threshold = thresholdValue
+		self.batchSize = batchSize
+		self.numPatches = 0
+
+		# sublist averages, one flattened row per sublist (grown as needed)
+		self.centroids = None
+
+
+	def numSublists(self):
+		""" Return the number of sublists """
+
+		return len(self.sublists)
+
+
+	def addPatch(self, index):
+		""" Add patch index of the store to sublist with best comparison value greater
+			than or equal to the threshold or create new sublist
+		"""
+
+		bestIndex, bestValue = self.getBestSublistIndex(Patch(pixels=self.store[index]))
+
+		# either add new sublist or add to sublist
+		if bestIndex is None or bestValue < self.threshold:
+			self.sublists.append(PatchSublist(self.store, index))
+			bestIndex = len(self.sublists) - 1
+		else:
+			self.sublists[bestIndex].add(index)
+
+		self.updateCentroid(bestIndex)
+		self.numPatches += 1
+
+
+	def addPatches(self, indices):
+		""" Add patch indices of the store to sublists, in mini-batches if batchSize is set """
+
+		if self.batchSize <= 0:
+			for index in indices:
+				self.addPatch(index)
+			return
+
+		indices = numpy.asarray(indices, dtype="int64")
+
+		for start in range(0, len(indices), self.batchSize):
+
+			batch = indices[start:(start + self.batchSize)]
+
+			if len(self.sublists) == 0:
+				self.addPatch(int(batch[0]))
+				batch = batch[1:]
+
+			if len(batch) == 0:
+				continue
+
+			# compare every patch of the batch against every sublist average
+			pixels = self.store.take(batch)
+			vectors = pixels.reshape(len(batch), -1)
+			distances = cdist(vectors, self.centroids[:len(self.sublists)], "cityblock")
+
+			labels = numpy.argmin(distances, axis=1)
+			values = 1.0 - (distances[numpy.arange(len(batch)), labels] / (vectors.shape[1] * 255.0))
+			assigned = (values >= self.threshold)
+
+			# add those meeting the threshold together
+			for sublistIndex in numpy.unique(labels[assigned]):
+				members = assigned & (labels == sublistIndex)
+				self.sublists[sublistIndex].addBatch(batch[members], pixels[members].sum(axis=0, dtype=self.sublists[sublistIndex].patch_sum.dtype))
+				self.updateCentroid(sublistIndex)
+
+			self.numPatches += int(numpy.count_nonzero(assigned))
+
+			# the rest may form new sublists
+			for index in batch[~assigned]:
+				self.addPatch(int(index))
+
+
+	def updateCentroid(self, sublistIndex):
+		""" Update the row of the centroid matrix for sublist sublistIndex """
+
+		avg = self.sublists[sublistIndex].getAvg().pixels
+
+		if self.centroids is None:
+			self.centroids = numpy.zeros((16, avg.size), dtype=avg.dtype)
+
+		# grow by doubling
+		if sublistIndex >= len(self.centroids):
+			self.centroids = numpy.concatenate((self.centroids, numpy.zeros(self.centroids.shape, dtype=self.centroids.dtype)))
+
+		self.centroids[sublistIndex] = avg.reshape(-1)
+
+
+	def getBestSublistIndex(self, patch):
+		""" Get (index, value) of the sublist whose average best matches patch """
+
+		if len(self.sublists) == 0:
+			return None, -1.0
+
+		# compare patch against the averages of every sublist at once
+		centroids = self.centroids[:len(self.sublists)]
+
+		return BestPatch.getBestIndex(patch, centroids.reshape((len(centroids), ) + self.sublists[0].avg.pixels.shape))
+
+
+	def getBestSublist(self, patch, thresholdCheck=False):
+		""" Get the best sublist match for this patch if greater than or equal to
+			threshold
+		"""
+
+		bestIndex, bestValue = self.getBestSublistIndex(patch)
+
+		if bestIndex is None:
+			return None
+
+		# check threshold
+		if thresholdCheck and bestValue < self.threshold:
+			return None
+
+		return self.sublists[bestIndex]
+
+
+	def getState(self):
+		""" Return dictionary of arrays from which setState can restore the sublists """
+
+		numSublists = len(self.sublists)
+
+		if numSublists == 0:
+			return {"sums": numpy.zeros((0, 0), dtype="int32"), "indices": numpy.zeros(0, dtype="int64"), "offsets": numpy.zeros(1, dtype="int64")}
+
+		return {
+			"sums": numpy.array([sublist.patch_sum.reshape(-1) for sublist in self.sublists]),
+			"indices": self.getAllIndices(),
+			"offsets": numpy.cumsum([0] + [len(sublist) for sublist in self.sublists]).astype("int64")
+		}
+
+
+	def setState(self, state):
+		""" Restore the sublists from a dictionary of arrays produced by getState,
+			their patches must already be in the store
+		"""
+
+		self.sublists = []
+		self.centroids = None
+		offsets = state["offsets"]
+
+		for sublistIndex in range(len(offsets) - 1):
+
+			indices = state["indices"][offsets[sublistIndex]:offsets[sublistIndex + 1]]
+
+			sublist = PatchSublist(self.store, int(indices[0]))
+			sublist.setState(indices, state["sums"][sublistIndex].reshape(sublist.patch_sum.shape))
+
+			self.sublists.append(sublist)
+			self.updateCentroid(sublistIndex)
+
+		self.numPatches = int(offsets[-1])
+
+
+	def getAllIndices(self):
+		""" Get an int64 array of the store indices of all patches contained by manager,
+			sublist after sublist
+		"""
+
+		if len(self.sublists) == 0:
+			return numpy.zeros(0, dtype="int64")
+
+		return numpy.concatenate([sublist.getIndices() for sublist in self.sublists])
+
+
+	def pack(self):
+		""" Hold the indices of every sublist in one array, each sublist keeping a view of
+			its part, dropping what the arrays grown while adding patches had spare
+		"""
+
+		indices = self.getAllIndices()
+		start = 0
+
+		for sublist in self.sublists:
+			sublist.indices = indices[start:(start + len(sublist))]
+			start += len(sublist)
+
+
+	def __len__(self):
+		""" Return number of patches stored in the manager """
+
+		return self.numPatches
+
+
+
+class SublistSamplePatches(SamplePatches):
+	""" Extension of Sample Patches where patches are organized into sublists 
+		organized by how well those patches match the average of each sublist.
+		If the best match is greater than or equal to a threshold, appends to
+		sublist, else, a new sublist is created.
+	"""
+
+	def __init__(self, img_set, img_read, thresholdValue, batchSize=0, cache=None, dedup=0, sampling=None):
+		""" Constructor """
+
+		SamplePatches.__init__(self, img_set, img_read, cache=cache, dedup=dedup, sampling=sampling)
+		self.threshold = thresholdValue
+		self.batchSize = batchSize
+
+
+	def generate(self, source_patch):
+
+		displayGenerateMsg = (not source_patch.getPatchSize() in self.samplePatches)
+
+		num = SamplePatches.generate(self, source_patch)
+
+		if displayGenerateMsg:
+			print "%d sublists generated in SublistPatchManager for a threshold of %.3f" % (self.samplePatches[self.iter_patch_size].numSublists(), self.threshold)
+
+		return num
+
+
+	def initPatches(self, key):
+		""" Initialize value for dictionary to be associated with current key """
+
+		self.samplePatches[key] = PatchSublistManager(self.threshold, PatchStore(key), self.batchSize)
+
+
+	def addSample(self, key, sample_img):
+		""" Add every patch of the sample image to the store and sort it into sublists """
+
+		manager = self.samplePatches[key]
+		start = len(manager.store)
+		self.addToStore(manager.store, key, sample_img)
+
+		with instrument.stats.timer("sublists"):
+			manager.addPatches(range(start, len(manager.store)))
+
+
+	def sublistsCacheKey(self, key):
+		""" Return the cache entry key for the sublists of key """
+
+		return self.cache.entryKey("sublists", self.cache.fingerprint(self.imgSet.samples), self.imgRead.shape[2], str(self.imgRead.dtype), key, self.threshold, self.batchSize, self.dedup, self.sampling.key())
+
+
+	def loadPatches(self, key):
+		""" Load sublists for key from the cache, returns whether they were loaded """
+
+		if self.cache is None:
+			return False
+
+		state = self.cache.load(self.sublistsCacheKey(key))
+
+		if state is None:
+			return False
+
+		manager = self.samplePatches[key]
+
+		self.sampling.start(len(self.getValidSamples()))
+
+		for sampleImgRead in self.readSamples():
+			self.addToStore(manager.store, key, sampleImgRead)
+
+		manager.setState(state)
+
+		return True
+
+
+	def savePatches(self, key):
+		""" Pack the sublists for key once built and save them to the cache """
+
+		self.samplePatches[key].pack()
+
+		if self.cache is not None:
+			self.cache.save(self.sublistsCacheKey(key), self.samplePatches[key].getState())
+
+
+	def getStore(self, key):
+		""" Return the PatchStore holding the sample patches for key """
+
+		return self.samplePatches[key].store
+
+
+	def numPatches(self, key):
+		""" Return number of patches associated with key """
+
+		return len(self.samplePatches[key])
+
+
+	def setPatch(self, source_patch):
+		""" Pass in a patch to get best patch sublist from sample patch generation 
+			(perform if needed) and then this is usable for iteration on that sublist
+		"""
+
+		self.iter_counter = -1
+
+		# generate and then grab sublist that matches
+		self.generate(source_patch)
+		bestSublist = self.samplePatches[self.iter_patch_size].getBestSublist(source_patch)
+		self.iter_list = bestSublist.getIndices() if bestSublist is not None else numpy.zeros(0, dtype="int64")
+		self.iter_max = len(self.iter_list)
+
+
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# # Indexed Sample Patches # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+class IndexedSamplePatches(SamplePatches):
+	""" Extension of Sample Patches where the patches of each size are flattened into
+		vectors held in a KD-tree searched with the Manhattan (L1) distance, the same
+		metric as Patch.comparePatches. An eps of 0 gives the exact best patch (same
+		choice as a linear search), eps > 0 allows a patch whose distance is within a
+		factor of (1 + eps) of the best.
+		Identical patches, common in flat regions, are indexed once as the first of them
+		in the store, which keeps the tree balanced and the exact tie-break cheap.
+	"""
+
+	def __init__(self, img_set, img_read, eps=0.0, cache=None, dedup=0, sampling=None):
+		""" Constructor """
+
+		SamplePatches.__init__(self, img_set, img_read, cache=cache, dedup=dedup, sampling=sampling)
+
+		if eps < 0:
+			print "eps in IndexedSamplePatches should be non-negative"
+
+		self.eps = eps
+		self.trees = {}
+
+		# store index of each point of the trees
+		self.treeIndices = {}
+
+
+	def generate(self, source_patch):
+		""" Generate sample patches and their index if needed """
+
+		num = SamplePatches.generate(self, source_patch)
+
+		if not self.iter_patch_size in self.trees and num > 0:
+			print "Building index ", self.iter_patch_size
+
+			with instrument.stats.timer("index"):
+				vectors, self.treeIndices[self.iter_patch_size] = numpy.unique(self.getStore(self.iter_patch_size).vectors(), axis=0, return_index=True)
+				self.trees[self.iter_patch_size] = cKDTree(vectors)
+
+		return num
+
+
+	def getBestIndex(self, patch):
+		""" Get (index, value) of the closest patch to patch using the index """
+
+		if not self.iter_patch_size in self.trees:
+			return None, -1.0
+
+		tree = self.trees[self.iter_patch_size]
+		vector = patch.pixels.reshape(-1).astype("float64")
+
+		if len(vector) != tree.m:
+			return 0, 0.0
+
+		distance, index = tree.query(vector, k=1, eps=self.eps, p=1)
+		instrument.stats.count("candidates")
+
+		treeIndices = self.treeIndices[self.iter_patch_size]
+		index = treeIndices[index]
+
+		# exact search, prefer the first of equally close patches as a linear search would
+		if self.eps == 0:
+			index = treeIndices[tree.query_ball_point(vector, distance, p=1)].min()
+
+		return int(index), 1.0 - (distance / (patch.pixels.size * 255.0))
+
+
+
+
+class PCASamplePatches(SamplePatches):
+	""" Extension of Sample Patches where the patches of each size are projected onto
+		their first k principal components and held in a KD-tree. The m nearest patches
+		in the reduced space are candidates, reranked with the exact metric of
+		Patch.comparePatches, trading a small loss in quality for speed on large
+		patch sizes. As in IndexedSamplePatches, identical patches are indexed once.
+	"""
+
+	# max number of sample patches used to fit the components
+	fit_samples = 20000
+
+
+	def __init__(self, img_set, img_read, components=8, candidates=16, cache=None, dedup=0, sampling=None):
+		""" Constructor """
+
+		SamplePatches.__init__(self, img_set, img_read, cache=cache, dedup=dedup, sampling=sampling)
+
+		if components < 1 or candidates < 1:
+			print "components and candidates in PCASamplePatches should be at least 1"
+
+		self.components = max(1, components)
+		self.candidates = max(1, candidates)
+		self.projections = {}
+		self.trees = {}
+
+		# store index of each point of the trees
+		self.treeIndices = {}
+
+
+	def generate(self, source_patch):
+		""" Generate sample patches, fit their components and build the index if needed """
+
+		num = SamplePatches.generate(self, source_patch)
+		key = self.iter_patch_size
+
+		if not key in self.trees and num > 0:
+
+			print "Fitting %d components and building index " % (self.components, ), key
+
+			with instrument.stats.timer("index"):
+				self.fit(key)
+
+		return num
+
+
+	def fit(self, key):
+		""" Fit the components of the sample patches for key and index their projections """
+
+		vectors = self.getStore(key).vectors()
+
+		# fit on a reproducible subset for large sample sets
+		fit_vectors = vectors
+		if len(vectors) > self.fit_samples:
+			fit_vectors = vectors[numpy.random.RandomState(0).choice(len(vectors), self.fit_samples, replace=False)]
+
+		fit_vectors = fit_vectors.astype("float64")
+		mean = fit_vectors.mean(axis=0)
+		u, singular, components = numpy.linalg.svd(fit_vectors - mean, full_matrices=False)
+
+		self.projections[key] = (mean, components[:self.components].T)
+
+		# index the distinct patches only
+		vectors, self.treeIndices[key] = numpy.unique(vectors, axis=0, return_index=True)
+		self.trees[key] = cKDTree(self.project(key, vectors.astype("float64")))
+
+
+	def project(self, key, vectors):
+		""" Project flattened patch vectors onto the components fit for key """
+
+		mean, basis = self.projections[key]
+
+		return numpy.dot(vectors - mean, basis)
+
+
+	def getBestIndex(self, patch):
+		""" Get (index, value) of the best of the nearest candidates in the reduced space,
+			reranked with the exact metric
+		"""
+
+		key = self.iter_patch_size
+
+		if not key in self.trees:
+			return None, -1.0
+
+		tree = self.trees[key]
+		vector = patch.pixels.reshape(1, -1).astype("float64")
+
+		if vector.shape[1] != len(self.projections[key][0]):
+			return 0, 0.0
+
+		distances, indices = tree.query(self.project(key, vector)[0], k=min(self.candidates, tree.n))
+
+		# sorted so the first of equally close patches wins, as in a linear search
+		indices = numpy.sort(self.treeIndices[key][numpy.atleast_1d(indices)])
+		instrument.stats.count("candidates", len(indices))
+
+		bestIndex, bestValue = BestPatch.getBestIndex(patch, self.getStore(key).take(indices))
+
+		return int(indices[bestIndex]), bestValue
+
+
+
+
+# ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^
+# ^ Pruned Sample Patches ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^ ^
+
+class PrunedSamplePatches(SamplePatches):
+	""" Extension of Sample Patches searched exhaustively but with most patches pruned
+		by cheap lower bounds on their distance (sum of absolute differences):
+		the difference of the sums of the patches, and the sum of the differences of
+		their per channel sums. Patches are presorted by sum, so the search starts with
+		patches of about the same sum as the source patch and works outwards, stopping
+		once the difference of sums alone is more than the best distance found.
+		The result is the same as a linear search.
+	"""
+
+	# number of patches bounded and compared at a time on each side
+	chunk_size = 256
+
+
+	def __init__(self, img_set, img_read, cache=None, dedup=0, sampling=None):
+		""" Constructor """
+
+		SamplePatches.__init__(self, img_set, img_read, cache=cache, dedup=dedup, sampling=sampling)
+		self.sorted = {}
+
+
+	def generate(self, source_patch):
+		""" Generate sample patches and sort them by sum if needed """
+
+		num = SamplePatches.generate(self, source_patch)
+
+		if not self.iter_patch_size in self.sorted and num > 0:
+
+			with instrument.stats.timer("index"):
+				self.sort(self.iter_patch_size)
+
+		return num
+
+
+	def sort(self, key):
+		""" Sort the sample patches for key by sum, keeping their per channel sums """
+
+		vectors = self.getStore(key).vectors()
+		channels = self.imgRead.shape[2]
+
+		channelSums = vectors.reshape(len(vectors), -1, channels).sum(axis=1, dtype=Patch.integerTypes(vectors.dtype)[1])
+		sums = channelSums.sum(axis=1, dtype=channelSums.dtype)
+		order = numpy.argsort(sums, kind="mergesort")
+
+		self.sorted[key] = (order, sums[order], channelSums[order], vectors[order])
+
+
+	def getBestIndex(self, patch):
+		""" Get (index, value) of the closest patch to patch, pruning by the bounds """
+
+		return self.getBestIndexWithin(patch, None)
+
+
+	def getBestIndexWithin(self, patch, distance):
+		""" Get (index, value) of the closest patch to patch closer than distance, pruning by
+			the bounds from the start, or (None, -1.0). No limit when distance is None.
+		"""
+
+		if not self.iter_patch_size in self.sorted:
+			return None, -1.0
+
+		order, sums, channelSums, vectors = self.sorted[self.iter_patch_size]
+
+		if vectors.shape[1] != patch.pixels.size:
+			return 0, 0.0
+
+		patchChannelSums = patch.pixels.reshape(-1, patch.pixels.shape[-1]).sum(axis=0, dtype="int64")
+		patchSum = patchChannelSums.sum()
+
+		bestDistance = distance
+		bestIndex = None
+
+		# window [low, high) of sorted patches searched, grown a chunk at a time on each side
+		low = high = int(numpy.searchsorted(sums, patchSum))
+
+		while low > 0 or high < len(sums):
+
+			chunks = []
+
+			if high < len(sums) and (bestDistance is None or sums[high] - patchSum <= bestDistance):
+				chunks.append((high, min(high + self.chunk_size, len(sums))))
+				high = chunks[-1][1]
+
+			if low > 0 and (bestDistance is None or patchSum - sums[low - 1] <= bestDistance):
+				chunks.append((max(0, low - self.chunk_size), low))
+				low = chunks[-1][0]
+
+			# the bounds of neither side can beat the best
+			if len(chunks) == 0:
+				break
+
+			for start, end in chunks:
+
+				bounds = numpy.abs(channelSums[start:end] - patchChannelSums).sum(axis=1)
+				keep = numpy.flatnonzero(bounds <= bestDistance) if bestDistance is not None else numpy.arange(end - start)
+				instrument.stats.count("candidates", end - start)
+
+				if len(keep) == 0:
+					continue
+
+				distances = Patch.distanceBatch(patch, vectors[start + keep].reshape((len(keep), ) + patch.pixels.shape))
+				indices = order[start + keep]
+
+				# closest, the first in the store if equally close as a linear search would
+				chunkBest = numpy.lexsort((indices, distances))[0]
+
+				if bestDistance is None or distances[chunkBest] < bestDistance or (bestIndex is not None and distances[chunkBest] == bestDistance and indices[chunkBest] < bestIndex):
+					bestDistance = int(distances[chunkBest])
+					bestIndex = int(indices[chunkBest])
+
+		if bestIndex is None:
+			return None, -1.0
+
+		return bestIndex, Patch.similarity(patch, bestDistance)
+
+
+
+
+# % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % %
+# % Pyramid Sample Patches  % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % % %
+
+class PatchPyramid:
+	""" Functions for mean image pyramids, level 0 being the image itself and each
+		level after half the size of the one before
+	"""
+
+	@staticmethod
+	def downsample(img_arr):
+		""" Halve the size of img_arr by averaging 2x2 blocks of pixels (odd edges repeated) """
+
+		padded = numpy.pad(img_arr, ((0, img_arr.shape[0] % 2), (0, img_arr.shape[1] % 2), (0, 0)), mode="edge").astype("float64")
+		mean = (padded[0::2, 0::2] + padded[1::2, 0::2] + padded[0::2, 1::2] + padded[1::2, 1::2]) / 4.0
+
+		return numpy.rint(mean).astype(img_arr.dtype)
+
+
+	@staticmethod
+	def build(img_arr, levels):
+		""" Return list of the levels of the pyramid of img_arr """
+
+		pyramid = [img_arr]
+
+		for level in range(1, levels):
+			pyramid.append(PatchPyramid.downsample(pyramid[-1]))
+
+		return pyramid
+
+
+	@staticmethod
+	def levelSize(size, level):
+		""" Size (px_width, px_height) of an image of size at level """
+
+		for i in range(level):
+			size = ((size[0] + 1) // 2, (size[1] + 1) // 2)
+
+		return size
+
+
+
+class PyramidSamplePatches(SamplePatches):
+	""" Extension of Sample Patches with a PatchStore for each level of the pyramids of the
+		sample images and patch size. Only samples that still fit the general patch size at
+		the coarsest level are used so a sample has the same image index at every level.
+	"""
+
+	def __init__(self, img_set, img_read, levels, patch_size, cache=None):
+		""" Constructor """
+
+		SamplePatches.__init__(self, img_set, img_read, cache)
+
+		self.levels = levels
+		self.general_patch_size = patch_size
+		self.pyramids = None
+		self.stores = {}
+
+
+	def samplePyramids(self):
+		""" Return the pyramids of the usable samples, list of images per level """
+
+		if self.pyramids is None:
+
+			with instrument.stats.timer("generate"):
+
+				self.pyramids = [[] for level in range(self.levels)]
+
+				for sampleImgRead in self.readSamples():
+
+					coarsest = PatchPyramid.levelSize((sampleImgRead.shape[1], sampleImgRead.shape[0]), self.levels - 1)
+
+					if coarsest[0] < self.general_patch_size[0] or coarsest[1] < self.general_patch_size[1]:
+						continue
+
+					for level, levelImg in enumerate(PatchPyramid.build(sampleImgRead, self.levels)):
+						self.pyramids[level].append(levelImg)
+
+		return self.pyramids
+
+
+	def getLevelStore(self, level, key):
+		""" Return the PatchStore of the samples at level for patch size key """
+
+		if not (level, key) in self.stores:
+
+			store = PatchStore(key)
+
+			for levelImg in self.samplePyramids()[level]:
+				store.addImage(levelImg)
+
+			self.stores[(level, key)] = store
+
+		return self.stores[(level, key)]
+
+
+	def getBestIndexAt(self, patch, level):
+		""" Get (index, value) of the closest patch to patch among all the samples at level """
+
+		return self.getLevelStore(level, patch.getPatchSize()).getBestIndex(patch)
+
+
+	def getBestIndexNear(self, patch, level, imageIndex, y, x, radius):
+		""" Get (index, value) of the closest patch to patch among those of the sample imageIndex
+			at level with upper left corner within radius pixels of (y, x)
+		"""
+
+		store = self.getLevelStore(level, patch.getPatchSize())
+		view = store.views[imageIndex]
+
+		startY = min(max(0, y - radius), view.shape[0] - 1)
+		endY = max(min(view.shape[0], y + radius + 1), startY + 1)
+		startX = min(max(0, x - radius), view.shape[1] - 1)
+		endX = max(min(view.shape[1], x + radius + 1), startX + 1)
+
+		window = view[startY:endY, startX:endX]
+		bestIndex, bestValue = BestPatch.getBestIndex(patch, window.reshape((-1, ) + window.shape[2:]))
+		instrument.stats.count("candidates", window.shape[0] * window.shape[1])
+
+		windowY, windowX = divmod(bestIndex, window.shape[1])
+
+		return store.indexOf(imageIndex, startY + windowY, startX + windowX), bestValue
+
+
+	def getLevelPatch(self, level, key, index):
+		""" Get patch index of the samples at level for patch size key """
+
+		return Patch(pixels=self.getLevelStore(level, key)[index])
+
+
+
+
+# & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & &
+# & PatchMatch  & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & & &
+
+class PatchMatchField:
+	""" Nearest neighbour field over the SplitPatchInfo grid of a source: for every patch of the
+		grid, the sample position (image index, y, x) of its best match found so far and its
+		distance. Starting from random positions, each iteration improves every patch by
+		trying the matches of its neighbours (shifted by a patch, as neighbouring patches
+		usually match neighbouring sample positions) and random positions around its match
+		in decreasing radii, so each patch costs about the same no matter how many sample
+		patches there are.
+	"""
+
+	def __init__(self, img_read, patch_size, samplePatches, level=0, seed=0):
+		""" Constructor, samplePatches is a PyramidSamplePatches (its samples at level are used) """
+
+		self.patch_size = patch_size
+		self.samplePatches = samplePatches
+		self.level = level
+		self.random = numpy.random.RandomState(seed)
+
+		# source patches and bounds of the grid
+		splitPatchInfo = SplitPatchInfo(img_read, patch_size)
+		self.patchRows = splitPatchInfo.patchRows
+		self.patchCols = splitPatchInfo.patchCols
+		self.patches = list(splitPatchInfo)
+
+		self.image = numpy.zeros((self.patchRows, self.patchCols), dtype="int64")
+		self.y = numpy.zeros((self.patchRows, self.patchCols), dtype="int64")
+		self.x = numpy.zeros((self.patchRows, self.patchCols), dtype="int64")
+		self.distance = numpy.zeros((self.patchRows, self.patchCols), dtype="int64")
+
+
+	def views(self, patchRow, patchCol):
+		""" Sample window views for the size of the patch at (patchRow, patchCol) """
+
+		source_patch = self.patches[patchRow * self.patchCols + patchCol][0]
+
+		return self.samplePatches.getLevelStore(self.level, source_patch.getPatchSize()).views
+
+
+	def initialize(self):
+		""" Set every patch to a random sample position """
+
+		for patchRow in range(self.patchRows):
+			for patchCol in range(self.patchCols):
+
+				views = self.views(patchRow, patchCol)
+				imageIndex = self.random.randint(len(views))
+
+				self.image[patchRow, patchCol] = imageIndex
+				self.y[patchRow, patchCol] = self.random.randint(views[imageIndex].shape[0])
+				self.x[patchRow, patchCol] = self.random.randint(views[imageIndex].shape[1])
+				self.distance[patchRow, patchCol] = self.evaluate(patchRow, patchCol, [(imageIndex, self.y[patchRow, patchCol], self.x[patchRow, patchCol])])[1]
+
+
+	def evaluate(self, patchRow, patchCol, positions):
+		""" Return (position, distance) of the closest of the sample positions to the patch at
+			(patchRow, patchCol), positions are clipped to those valid for its size
+		"""
+
+		views = self.views(patchRow, patchCol)
+		source_patch = self.patches[patchRow * self.patchCols + patchCol][0]
+
+		clipped = []
+		for imageIndex, y, x in positions:
+			view = views[imageIndex]
+			clipped.append((imageIndex, min(max(0, y), view.shape[0] - 1), min(max(0, x), view.shape[1] - 1)))
+
+		distances = Patch.distanceBatch(source_patch, numpy.array([views[imageIndex][y, x] for imageIndex, y, x in clipped]))
+		instrument.stats.count("candidates", len(clipped))
+
+		best = int(numpy.argmin(distances))
+
+		return clipped[best], int(distances[best])
+
+
+	def candidates(self, patchRow, patchCol, forward):
+		""" Sample positions to try for the patch at (patchRow, patchCol): neighbour matches shifted
+			by a patch (left and above going forward, right and below going backward) and random
+			positions around the current match
+		"""
+
+		step = 1 if forward else -1
+		positions = []
+
+		# propagation
+		neighbourCol = patchCol - step
+		if 0 <= neighbourCol < self.patchCols:
+			positions.append((self.image[patchRow, neighbourCol], self.y[patchRow, neighbourCol], self.x[patchRow, neighbourCol] + step * self.patch_size[0]))
+
+		neighbourRow = patchRow - step
+		if 0 <= neighbourRow < self.patchRows:
+			positions.append((self.image[neighbourRow, patchCol], self.y[neighbourRow, patchCol] + step * self.patch_size[1], self.x[neighbourRow, patchCol]))
+
+		# random search around current match, radius halving down to a pixel
+		imageIndex, y, x = self.image[patchRow, patchCol], self.y[patchRow, patchCol], self.x[patchRow, patchCol]
+		views = self.views(patchRow, patchCol)
+		radius = max(views[imageIndex].shape[:2])
+
+		while radius >= 1:
+			positions.append((imageIndex, y + self.random.randint(-radius, radius + 1), x + self.random.randint(-radius, radius + 1)))
+			radius //= 2
+
+		# and anywhere in another sample
+		otherIndex = self.random.randint(len(views))
+		positions.append((otherIndex, self.random.randint(views[otherIndex].shape[0]), self.random.randint(views[otherIndex].shape[1])))
+
+		return positions
+
+
+	def iterate(self, forward=True):
+		""" Improve every patch once, scanning forward (from upper left) or backward """
+
+		patchRows = range(self.patchRows) if forward else reversed(range(self.patchRows))
+
+		for patchRow in patchRows:
+
+			patchCols = range(self.patchCols) if forward else reversed(range(self.patchCols))
+
+			for patchCol in patchCols:
+
+				(imageIndex, y, x), distance = self.evaluate(patchRow, patchCol, self.candidates(patchRow, patchCol, forward))
+
+				if distance < self.distance[patchRow, patchCol]:
+					self.image[patchRow, patchCol] = imageIndex
+					self.y[patchRow, patchCol] = y
+					self.x[patchRow, patchCol] = x
+					self.distance[patchRow, patchCol] = distance
+
+
+	def run(self, iterations):
+		""" Initialize and iterate, alternating scan direction """
+
+		self.initialize()
+
+		for iteration in range(iterations):
+			self.iterate(forward=(iteration % 2 == 0))
+			print "Iteration %d mean distance %.2f" % (iteration + 1, self.distance.mean())
+
+
+	def write(self, img_write):
+		""" Write the matched sample patch of every patch to img_write """
+
+		for patchNum, (source_patch, bounds) in enumerate(self.patches):
+
+			patchRow, patchCol = divmod(patchNum, self.patchCols)
+			view = self.views(patchRow, patchCol)[self.image[patchRow, patchCol]]
+
+			bounds.boundWrite(img_write, Patch(pixels=view[self.y[patchRow, patchCol], self.x[patchRow, patchCol]]))
@@ -0,0 +1,414 @@
+# * * * * * * * * * * * * * * * * * * * *
+# * server.py
+# *
+# * Long running HTTP service re-drawing
+# * images against named sample sets
+# * kept in memory between requests
+# *
+# * * * * * * * * * * * * * * * * * * * *
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import cStringIO
+import collections
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import urlparse
+import numpy
+from scipy import misc
+import img
+import instrument
+from arachne import addTechniqueArguments
+from arachne import patchSize
+from arachne import sampleTechnique
+from patch import ImgSet
+from cache import SampleCache
+
+
+
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
+# * Sample sets
+
+# state of a worker process, set by initWorker when it is forked
+_workerState = None
+
+
+def memoryUsage(obj, seen=None):
+	""" Estimate bytes held by the arrays reachable from obj (through attributes, lists,
+		tuples and dictionaries), each underlying buffer counted once so views onto the
+		sample images add nothing
+	"""
+
+	if seen is None:
+		seen = set()
+
+	if isinstance(obj, numpy.ndarray):
+
+		# strided views (as_strided) keep the array they view as base of their base
+		owner = obj
+		while owner.base is not None:
+
+			base = owner.base if isinstance(owner.base, numpy.ndarray) else getattr(owner.base, "base", None)
+
+			if not isinstance(base, numpy.ndarray):
+				break
+
+			owner = base
+
+		if id(owner) in seen:
+			return 0
+
+		seen.add(id(owner))
+
+		return owner.nbytes
+
+	if id(obj) in seen:
+		return 0
+
+	seen.add(id(obj))
+
+	if isinstance(obj, dict):
+		return sum(memoryUsage(key, seen) + memoryUsage(value, seen) for key, value in obj.items())
+
+	if isinstance(obj, (list, tuple)):
+		return sum(memoryUsage(value, seen) for value in obj)
+
+	# KD-trees keep their data and index arrays
+	if hasattr(obj, "data") and hasattr(obj, "indices") and isinstance(getattr(obj, "data"), numpy.ndarray):
+		return memoryUsage(obj.data, seen) + memoryUsage(obj.indices, seen)
+
+	if hasattr(obj, "__dict__"):
+		return memoryUsage(obj.__dict__, seen)
+
+	return 0
+
+
+def initWorker(samplePatches, getBestPatch):
+	""" Keep the sample patches of the sample set of the pool in the worker process, which
+		has them from the parent without a copy as it is forked
+	"""
+
+	global _workerState
+	_workerState = (samplePatches, getBestPatch)
+
+	# the parent may have been holding the lock on another thread when forked
+	instrument.stats.lock = threading.Lock()
+
+	sys.stdout = open(os.devnull, "w")
+
+
+def redrawJob(img_read, patch_size):
+	""" Re-draw img_read in a worker process with the sample patches of its pool """
+
+	samplePatches, getBestPatch = _workerState
+
+	return img.redraw(img_read, patch_size, samplePatches, getBestPatch)
+
+
+
+class SampleSet:
+	""" Sample patches of a named sample directory for one pixel encoding, with the pool of
+		worker processes re-drawing against them. The sample patches are generated in this
+		process and the pool is forked after, so every job shares them. When a job needs
+		sizes not generated yet they are generated and a new pool is forked, the old one
+		finishing the jobs it was given.
+	"""
+
+	def __init__(self, samplePatches, getBestPatch, augment, workers):
+		""" Constructor """
+
+		self.samplePatches = samplePatches
+		self.getBestPatch = getBestPatch
+		self.augment = augment
+		self.workers = workers
+
+		self.lock = threading.Lock()
+		self.pool = None
+		self.sizes = set()
+		self.jobs = 0
+		self.memory = memoryUsage(samplePatches)
+
+
+	def submit(self, img_read, patch_size):
+		""" Start re-drawing img_read, returns multiprocessing AsyncResult of the re-drawn image """
+
+		with self.lock:
+
+			sizes = set(img.generatedSizes(img_read, patch_size, self.augment))
+
+			if self.pool is None or not sizes <= self.sizes:
+
+				for size in sorted(sizes - self.sizes):
+					self.samplePatches.generateSize(size)
+
+				self.sizes |= sizes
+				self.memory = memoryUsage(self.samplePatches)
+				self.retire()
+				self.pool = multiprocessing.Pool(self.workers, initWorker, (self.samplePatches, self.getBestPatch))
+
+			return self.pool.apply_async(redrawJob, (img_read, patch_size))
+
+
+	def retire(self):
+		""" Stop the pool once it has finished its jobs, without waiting for it """
+
+		if self.pool is not None:
+			self.pool.close()
+			threading.Thread(target=self.pool.join).start()
+			self.pool = None
+
+
+
+class SampleSets:
+	""" Named sample sets loaded when first used and kept while the memory of those not in
+		use (least recently used first) fits within budget bytes. Concurrent jobs against a
+		set share it, and it is only loaded once.
+	"""
+
+	def __init__(self, sample_dirs, createSamplePatches, getBestPatch, augment, workers, budget):
+		""" Constructor """
+
+		self.sampleDirs = sample_dirs
+		self.createSamplePatches = createSamplePatches
+		self.getBestPatch = getBestPatch
+		self.augment = augment
+		self.workers = workers
+		self.budget = budget
+
+		self.lock = threading.Lock()
+		self.loading = {}
+		self.sets = collections.OrderedDict()
+
+
+	def acquire(self, name, img_read):
+		""" Return the SampleSet of name for the pixel encoding of img_read, loading it if needed,
+			to be released with release once its job is done
+		"""
+
+		key = (name, img_read.shape[2], str(img_read.dtype))
+
+		with self.lock:
+
+			if not key in self.loading:
+				self.loading[key] = threading.Lock()
+
+			loading = self.loading[key]
+
+		# one thread loads the set, others asking for it meanwhile wait for it
+		with loading:
+
+			with self.lock:
+
+				sampleSet = self.sets.pop(key, None)
+
+				if sampleSet is not None:
+					sampleSet.jobs += 1
+					self.sets[key] = sampleSet
+					return sampleSet
+
+			img_set = ImgSet(src='', samples=self.samples(name), dest='')
+			sampleSet = SampleSet(self.createSamplePatches(img_set, img_read), self.getBestPatch, self.augment, self.workers)
+
+			with self.lock:
+				sampleSet.jobs += 1
+				self.sets[key] = sampleSet
+
+			print "Loaded sample set %s %s" % (name, key[1:])
+
+		return sampleSet
+
+
+	def release(self, sampleSet):
+		""" Done with a job against sampleSet, evicts sets while over budget """
+
+		with self.lock:
+			sampleSet.jobs -= 1
+			self.evict()
+
+
+	def evict(self):
+		""" Drop least recently used sets not in use while over budget (lock held) """
+
+		for key in list(self.sets.keys()):
+
+			if sum(sampleSet.memory for sampleSet in self.sets.values()) <= self.budget:
+				break
+
+			if self.sets[key].jobs == 0:
+				self.sets.pop(key).retire()
+				print "Evicted sample set %s %s" % (key[0], key[1:])
+
+
+	def samples(self, name):
+		""" Return list of the sample images of the sample set name """
+
+		samples = []
+
+		for root, dirs, files in os.walk(self.sampleDirs[name]):
+			for sample_file in files:
+				if ImgSet.allowedFileType(sample_file):
+					samples.append(os.path.join(root, sample_file))
+
+		return sorted(samples)
+
+
+	def status(self):
+		""" Return list of dictionaries describing the sample sets """
+
+		with self.lock:
+			loaded = dict((key, sampleSet) for key, sampleSet in self.sets.items())
+
+		status = []
+
+		for name in sorted(self.sampleDirs.keys()):
+
+			sets = [(key, sampleSet) for key, sampleSet in loaded.items() if key[0] == name]
+			status.append({
+				"name": name,
+				"loaded": [{"channels": key[1], "dtype": key[2], "bytes": sampleSet.memory, "jobs": sampleSet.jobs, "patch_sizes": sorted(sampleSet.sizes)} for key, sampleSet in sets]
+			})
+
+		return status
+
+
+
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
+# * HTTP
+
+class RedrawServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	""" HTTP server handling each request on its own thread, re-drawing in the worker
+		processes of the sample sets
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, address, sampleSets, patch_size):
+		""" Constructor """
+
+		BaseHTTPServer.HTTPServer.__init__(self, address, RedrawHandler)
+
+		self.sampleSets = sampleSets
+		self.patchSize = patch_size
+
+
+
+class RedrawHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	""" GET /sets lists the sample sets. POST /redraw/<set>[?patch_size=WxH] with an image as
+		the body re-draws it against the sample set, responding with the re-drawn PNG.
+	"""
+
+	def do_GET(self):
+		""" List sample sets """
+
+		if urlparse.urlparse(self.path).path != "/sets":
+			return self.respond(404, "text/plain", "Not found\n")
+
+		self.respond(200, "application/json", json.dumps(self.server.sampleSets.status(), indent=2))
+
+
+	def do_POST(self):
+		""" Re-draw the image in the body """
+
+		url = urlparse.urlparse(self.path)
+		parts = url.path.strip("/").split("/")
+
+		if len(parts) != 2 or parts[0] != "redraw" or not parts[1] in self.server.sampleSets.sampleDirs:
+			return self.respond(404, "text/plain", "Unknown sample set\n")
+
+		try:
+			query = urlparse.parse_qs(url.query)
+			patch_size = patchSize(query["patch_size"][0]) if "patch_size" in query else self.server.patchSize
+
+			img_read = misc.imread(cStringIO.StringIO(self.rfile.read(int(self.headers.getheader("Content-Length", 0)))))
+
+		except Exception as error:
+			return self.respond(400, "text/plain", "Invalid request: %s\n" % (error, ))
+
+		if img_read.ndim != 3 or patch_size[0] > img_read.shape[1] or patch_size[1] > img_read.shape[0]:
+			return self.respond(400, "text/plain", "Image must have channels and be at least the patch size\n")
+
+		sampleSet = self.server.sampleSets.acquire(parts[1], img_read)
+
+		try:
+			img_write = sampleSet.submit(img_read, patch_size).get()
+		finally:
+			self.server.sampleSets.release(sampleSet)
+
+		out = cStringIO.StringIO()
+		misc.toimage(img_write, channel_axis=2).save(out, format="PNG")
+
+		self.respond(200, "image/png", out.getvalue())
+
+
+	def respond(self, code, content_type, body):
+		""" Send response with body """
+
+		self.send_response(code)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+
+def sampleSetDir(value):
+	""" Parse a named sample set given as name=sample/dir for argparse """
+
+	name, separator, sample_dir = value.partition("=")
+
+	if separator == "" or name == "" or not os.path.isdir(sample_dir):
+		raise argparse.ArgumentTypeError("sample set must be given as name=sample/dir of an existing directory")
+
+	return (name, sample_dir)
+
+
+
+def main():
+	""" Serve re-drawing requests """
+
+	parser = argparse.ArgumentParser(description='Serve re-drawing of images against named sample sets kept in memory')
+	parser.add_argument('--sample-set', metavar='NAME=DIR', type=sampleSetDir, action='append', required=True, help='sample set name and its directory of sample images, may be repeated')
+	parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+	parser.add_argument('--port', type=int, default=8080, help='port to listen on (default: 8080)')
+	parser.add_argument('--workers', metavar='N', type=int, default=multiprocessing.cpu_count(), help='worker processes re-drawing for each loaded sample set (default: number of CPUs)')
+	parser.add_argument('--memory-budget', metavar='MB', type=int, default=1024, help='sample sets not in use are evicted, least recently used first, while those loaded hold more (default: 1024)')
+	parser.add_argument('--cache-dir', metavar='DIR', type=str, default=None, help='directory to cache decoded samples and sublists in')
+	addTechniqueArguments(parser)
+
+	args = parser.parse_args()
+
+	if not args.technique in ['linear', 'sublists', 'indexed', 'pca', 'pruned']:
+		print "Technique %s can't be served." % (args.technique, )
+		sys.exit(1)
+
+	cache = None
+
+	if args.cache_dir is not None:
+		cache = SampleCache(args.cache_dir)
+
+	createSamplePatches, getBestPatch = sampleTechnique(args, cache)
+
+	# each worker process keeps its own memo across the jobs it re-draws
+	getBestPatch = img.searchFunction(getBestPatch, augment=args.augment, memo=args.memo, memo_quantize=args.memo_quantize)
+
+	sampleSets = SampleSets(dict(args.sample_set), createSamplePatches, getBestPatch, args.augment, max(1, args.workers), args.memory_budget * 1024 * 1024)
+
+	server = RedrawServer((args.host, args.port), sampleSets, args.patch_size)
+	print "Serving on http://%s:%d" % (args.host, args.port)
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+
+
+
+if __name__ == "__main__":
+	main()
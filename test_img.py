@@ -0,0 +1,162 @@
+# * * * * * * * * * * * * * * * * * * * *
+# * test_img.py
+# *
+# * Checks that the exact techniques and
+# * options re-draw the same image as
+# * img.linear, on tiny generated images
+# *
+# * Run with: python -m unittest test_img
+# * * * * * * * * * * * * * * * * * * * *
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import img
+from patch import ImgSet
+
+
+
+def generateImage(random, height, width, channels=3):
+	""" Random image (at least 8x8) with a flat band and a repeated block, so patches tie
+		and repeat
+	"""
+
+	img_arr = random.randint(0, 256, (height, width, channels)).astype("uint8")
+	img_arr[:height // 3] = img_arr[0, 0]
+	img_arr[-4:, -4:] = img_arr[-8:-4, -8:-4]
+
+	return img_arr
+
+
+
+class ImageTestCase(unittest.TestCase):
+	""" Source and sample images written to a temporary directory """
+
+	def setUp(self):
+
+		self.dir = tempfile.mkdtemp()
+		random = numpy.random.RandomState(0)
+
+		self.src = self.write("src.npy", generateImage(random, 11, 14))
+		self.samples = [self.write("a.npy", generateImage(random, 13, 16)), self.write("b.npy", generateImage(random, 9, 10))]
+
+
+	def tearDown(self):
+
+		shutil.rmtree(self.dir)
+
+
+	def write(self, name, img_arr):
+		""" Save img_arr in the temporary directory, returns its file name """
+
+		filename = os.path.join(self.dir, name)
+		numpy.save(filename, img_arr)
+
+		return filename
+
+
+	def imgSet(self, samples=None, dest="out.npy"):
+		""" ImgSet of the source and samples (or the given samples) """
+
+		return ImgSet(src=self.src, samples=(self.samples if samples is None else samples), dest=os.path.join(self.dir, dest))
+
+
+	def assertSameImage(self, expected, actual):
+
+		self.assertIsNotNone(actual)
+		self.assertEqual(expected.shape, actual.shape)
+		self.assertTrue((numpy.asarray(expected) == numpy.asarray(actual)).all())
+
+
+
+class TechniqueTest(ImageTestCase):
+	""" Exact techniques and options give the image img.linear does """
+
+	patch_size = (3, 3)
+
+
+	def setUp(self):
+
+		ImageTestCase.setUp(self)
+		self.expected = img.linear(self.imgSet(), self.patch_size)
+
+
+	def test_indexed_exact(self):
+		self.assertSameImage(self.expected, img.indexed(self.imgSet(), self.patch_size, eps=0.0))
+
+
+	def test_pruned(self):
+		self.assertSameImage(self.expected, img.pruned(self.imgSet(), self.patch_size))
+
+
+	def test_dedup_exact(self):
+		self.assertSameImage(self.expected, img.linear(self.imgSet(), self.patch_size, dedup=1))
+		self.assertSameImage(self.expected, img.pruned(self.imgSet(), self.patch_size, dedup=1))
+
+
+	def test_memo(self):
+		self.assertSameImage(self.expected, img.linear(self.imgSet(), self.patch_size, memo=50))
+
+
+	def test_workers(self):
+		self.assertSameImage(self.expected, img.linear(self.imgSet(), self.patch_size, workers=2))
+
+
+	def test_streaming(self):
+		self.assertSameImage(self.expected, img.linear(self.imgSet(dest="streamed.npy"), self.patch_size, strip_rows=1))
+
+
+	def test_patch_sizes(self):
+
+		img_writes = img.linear(self.imgSet(), [self.patch_size, (4, 2)])
+
+		self.assertSameImage(self.expected, img_writes[0])
+		self.assertSameImage(img.linear(self.imgSet(), (4, 2)), img_writes[1])
+
+
+	def test_augment(self):
+
+		expected = img.linear(self.imgSet(), (4, 2), augment=True)
+
+		self.assertSameImage(expected, img.pruned(self.imgSet(), (4, 2), augment=True))
+		self.assertSameImage(expected, img.indexed(self.imgSet(), (4, 2), augment=True))
+
+
+
+class EmptyStoreTest(ImageTestCase):
+	""" Options still re-draw when no sample patch is stored for a size """
+
+	def redrawn(self, samples, patch_size, **options):
+
+		img_set = self.imgSet(samples)
+		expected = img.linear(img_set, patch_size, **options)
+
+		self.assertIsNotNone(expected)
+		self.assertEqual(ImgSet.readImage(self.src).shape, expected.shape)
+
+		return expected
+
+
+	def test_no_valid_samples(self):
+
+		gray = self.write("gray.npy", numpy.zeros((8, 8, 1), dtype="uint8"))
+
+		self.assertSameImage(self.redrawn([gray], (3, 3)), self.redrawn([gray], (3, 3), dedup=1))
+
+
+	def test_samples_smaller_than_patch(self):
+
+		small = self.write("small.npy", numpy.zeros((3, 3, 3), dtype="uint8"))
+
+		self.assertSameImage(self.redrawn([small], (4, 2)), self.redrawn([small], (4, 2), dedup=1))
+		self.assertSameImage(self.redrawn([small], (4, 2), augment=True), self.redrawn([small], (4, 2), dedup=1, augment=True))
+
+
+
+
+if __name__ == "__main__":
+	unittest.main()